@@ -0,0 +1,377 @@
+#!/usr/bin/python
+"""
+Benchmarks the frame data query path against a local stand-in for the
+frame data endpoints serving synthetic dumps.
+
+    python benchmark.py --chars 60 --queries 5000 --concurrency 8
+
+The query mix is generated from --seed, so runs with the same
+arguments replay the same queries. It can also be saved with
+--save-queries and replayed later with --load-queries.
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import tracemalloc
+from aiohttp import web
+from commands import ifgc, stats, utilities
+from commands.framedata import load_dataset
+
+BUTTONS = ("LP", "MP", "HP", "LK", "MK", "HK")
+POSITIONS = (("Stand", "st", "5"), ("Crouch", "cr", "2"), ("Jump", "jp", "8"))
+SPECIALS = (
+    ("Hadoken", "Fireball", "236"),
+    ("Shoryuken", "DP", "623"),
+    ("Tatsumaki", "Tatsu", "214"),
+    ("Spinning Bird", "SBK", "22"),
+)
+CHAR_NAMES = [
+    "Ryu",
+    "Ken",
+    "Chun-Li",
+    "M.Bison",
+    "Guile",
+    "Zangief",
+    "Dhalsim",
+    "Cammy",
+    "Juri",
+    "Akuma",
+    "E.Honda",
+    "Dee Jay",
+    "Marisa",
+    "JP",
+    "Lily",
+    "Kimberly",
+    "Manon",
+    "Jamie",
+    "Luke",
+    "Blanka",
+    "A.K.I.",
+    "Rashid",
+    "Ed",
+    "Terry",
+    "Mai",
+    "Elena",
+    "Sol Badguy",
+    "Ky Kiske",
+    "May",
+    "Axl Low",
+]
+# The character states each game has besides the normal one and
+# whether some characters have their own extra states.
+GAMES = {
+    "sfv": (["vtOne", "vtTwo"], False),
+    "ggst": ([], False),
+    "sf6": ([], True),
+}
+
+
+def generate_move(rng, plain, numpad, common_name=None):
+    move = {
+        "plnCmd": plain,
+        "numCmd": numpad,
+        "startup": rng.randint(3, 20),
+        "active": "%s-%s" % (rng.randint(1, 3), rng.randint(4, 8)),
+        "recovery": rng.randint(5, 30),
+        "onHit": rng.choice(["KD", "+%s" % rng.randint(0, 6), str(rng.randint(-4, 0))]),
+        "onBlock": str(rng.randint(-30, 3)),
+        "kd": rng.randint(20, 40),
+        "kdr": rng.randint(10, 30),
+        "kdrb": rng.randint(15, 35),
+        "extraInfo": json.dumps(["Cancelable", "Hits %s times" % rng.randint(1, 3)]),
+    }
+    if common_name:
+        move["cmnName"] = common_name
+    if rng.random() < 0.2:
+        move["vtcOnHit"] = "+%s" % rng.randint(1, 5)
+    return move
+
+
+def generate_dump(game, chars=30, seed=0):
+    """
+    Returns a synthetic frame data dump and detail for a game,
+    shaped like the ones served by the real endpoints.
+    """
+    rng = random.Random("%s-%s" % (game, seed))
+    states, specific = GAMES[game]
+    names = CHAR_NAMES[:chars] + ["Char %s" % i for i in range(chars - len(CHAR_NAMES))]
+
+    data = {}
+    specific_states = {}
+    for name in names:
+        normal = {}
+        for position, short, numpad in POSITIONS:
+            for button in BUTTONS:
+                normal["%s %s" % (position, button)] = generate_move(
+                    rng, "%s.%s" % (short, button), numpad + button
+                )
+        for special, common_name, motion in SPECIALS:
+            for strength in ("LP", "MP", "HP", "EX"):
+                normal["%s %s" % (strength, special)] = generate_move(
+                    rng,
+                    "qcf+%s" % strength,
+                    motion + strength,
+                    "%s %s" % (strength, common_name),
+                )
+
+        moves = {"normal": normal}
+        for state in states:
+            moves[state] = {
+                name: dict(move, startup=move["startup"] - 1)
+                for name, move in rng.sample(sorted(normal.items()), 6)
+            }
+            moves[state]["%s Special" % state] = generate_move(rng, "HP+HK", "HP+HK")
+        if specific and rng.random() < 0.3:
+            moves["install"] = {
+                "Install Punch": generate_move(rng, "PPP", "PPP"),
+                "Install Kick": generate_move(rng, "KKK", "KKK"),
+            }
+            specific_states[name] = ["install"]
+
+        data[name] = {
+            "moves": moves,
+            "stats": {
+                "fDash": rng.randint(15, 20),
+                "bDash": rng.randint(20, 25),
+                "fWalk": "0.%s" % rng.randint(30, 60),
+                "bWalk": "0.%s" % rng.randint(20, 40),
+                "throwRange": "0.%s" % rng.randint(7, 9),
+                "health": rng.choice([900, 1000, 1050]),
+                "stun": rng.choice([900, 1000, 1050]),
+            },
+        }
+
+    detail = {
+        "characterStates": ["normal"] + states,
+        "specificCharacterStates": specific_states,
+    }
+    return data, detail
+
+
+def mangle(rng, value):
+    """
+    Makes a query out of a name the way people type them, lower
+    cased, shortened or with a typo.
+    """
+    value = value.lower()
+    roll = rng.random()
+    if roll < 0.3 and len(value) > 3:
+        return value[: rng.randint(3, len(value))]
+    if roll < 0.5 and len(value) > 3:
+        position = rng.randrange(len(value))
+        return value[:position] + value[position + 1 :]
+    return value
+
+
+def generate_queries(dumps, count, seed=0):
+    """
+    Returns a replayable list of (kind, game, args) queries, mixing
+    slash commands with the autocomplete calls leading up to them.
+    """
+    rng = random.Random(seed)
+    queries = []
+    while len(queries) < count:
+        game = rng.choice(sorted(dumps))
+        data, detail = dumps[game]
+        char = rng.choice(sorted(data))
+        moves = data[char]["moves"]
+        move_names = list(moves["normal"]) + list(data[char]["stats"])
+        move = rng.choice(move_names)
+        if rng.random() < 0.3:
+            move = rng.choice(
+                [value.get("plnCmd", move) for value in moves["normal"].values()]
+            )
+        char_query, move_query = mangle(rng, char), mangle(rng, move)
+        if rng.random() < 0.05:
+            move_query = "xyzzy"
+
+        state = None
+        if game == "sfv" and rng.random() < 0.2:
+            state = rng.choice(["1", "2"])
+        elif game == "sf6" and char in detail["specificCharacterStates"]:
+            state = rng.choice([None, "install"])
+
+        for length in range(1, len(char_query) + 1, 2):
+            queries.append(("autocomplete_char", game, [char_query[:length]]))
+        for length in range(0, len(move_query) + 1, 2):
+            queries.append(
+                ("autocomplete_move", game, [char_query, move_query[:length]])
+            )
+        queries.append(("slash", game, [char_query, move_query, state]))
+    return queries[:count]
+
+
+async def start_server(dumps, port):
+    """
+    Serves each games dump and detail the way the real endpoints do,
+    including answering conditional requests with a 304.
+    """
+    app = web.Application()
+    for game, (data, detail) in dumps.items():
+        body = json.dumps(data)
+        etag = '"%s"' % hash(body)
+
+        async def serve_data(request, body=body, etag=etag):
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304)
+            return web.Response(
+                text=body, content_type="application/json", headers={"ETag": etag}
+            )
+
+        async def serve_detail(request, detail=json.dumps(detail)):
+            return web.Response(text=detail, content_type="application/json")
+
+        app.router.add_get("/%s/data" % game, serve_data)
+        app.router.add_get("/%s/detail" % game, serve_detail)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def build_config(port, executor):
+    url = "http://127.0.0.1:%s/%s/%s"
+    return {
+        "frame_data": {
+            "sf5_url": url % (port, "sfv", "data"),
+            "sf5_detail_url": url % (port, "sfv", "detail"),
+            "ggst_url": url % (port, "ggst", "data"),
+            "ggst_detail_url": url % (port, "ggst", "detail"),
+            "sf6_url": url % (port, "sf6", "data"),
+            "sf6_detail_url": url % (port, "sf6", "detail"),
+            "snapshot_dir": "",
+            "index_executor": executor,
+        }
+    }
+
+
+async def run_query(modules, kind, game, args):
+    module = modules[game]
+    if kind == "slash":
+        char, move, state = args
+        if game == "sfv":
+            return await module.slash_sfv(char, move, state)
+        if game == "ggst":
+            return await module.slash_strive(char, move)
+        return await module.slash_sf6(char, move, state)
+    return await getattr(module, kind)(*args)
+
+
+async def run(args):
+    dumps = {game: generate_dump(game, args.chars, args.seed) for game in GAMES}
+    if args.load_queries:
+        with open(args.load_queries) as f:
+            queries = json.load(f)
+    else:
+        queries = generate_queries(dumps, args.queries, args.seed)
+    if args.save_queries:
+        with open(args.save_queries, "w") as f:
+            json.dump(queries, f)
+
+    # How long building a dataset out of a dump takes.
+    build = stats.Histogram()
+    for game, (data, detail) in dumps.items():
+        body = json.dumps(data)
+        for _ in range(args.build_rounds):
+            start_time = time.perf_counter()
+            load_dataset(body, detail)
+            build.record(time.perf_counter() - start_time)
+
+    runner = await start_server(dumps, args.port)
+    config = build_config(args.port, args.executor)
+    modules = {
+        "sfv": ifgc.Frames(config),
+        "ggst": ifgc.GGFrames(config),
+        "sf6": ifgc.SF6Frames(config),
+    }
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    await asyncio.gather(*[module.get_data() for module in modules.values()])
+    load_time = time.perf_counter() - start_time
+    _, load_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+
+    histograms = {"build": build}
+    pending = iter(queries)
+
+    async def worker():
+        for kind, game, query_args in pending:
+            query_start = time.perf_counter()
+            await run_query(modules, kind, game, query_args)
+            histograms.setdefault(kind, stats.Histogram()).record(
+                time.perf_counter() - query_start
+            )
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    total_time = time.perf_counter() - start_time
+    _, query_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    await utilities.close_session()
+    await utilities.close_cache()
+    await runner.cleanup()
+    utilities.shutdown_executors()
+
+    print(
+        "%s queries over %s chars per game, concurrency %s, executor %s"
+        % (len(queries), args.chars, args.concurrency, args.executor)
+    )
+    print("initial load %.3fs, peak memory %.1f MiB" % (load_time, load_peak / 2**20))
+    print(
+        "queries %.3fs, %.0f queries/s, peak memory %.1f MiB"
+        % (total_time, len(queries) / total_time, query_peak / 2**20)
+    )
+    print(
+        "%-18s %8s %10s %10s %10s %10s"
+        % ("", "count", "ops/s", "p50 ms", "p99 ms", "max ms")
+    )
+    for kind, histogram in histograms.items():
+        summary = histogram.summary()
+        # Operations per second if they were run back to back.
+        throughput = summary["count"] / (summary["mean"] * summary["count"] or 1)
+        print(
+            "%-18s %8s %10.0f %10.3f %10.3f %10.3f"
+            % (
+                kind,
+                summary["count"],
+                throughput,
+                summary["p50"] * 1000,
+                summary["p99"] * 1000,
+                summary["max"] * 1000,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chars", type=int, default=40, help="characters per game")
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--executor", default="thread", choices=["thread", "process", "none"]
+    )
+    parser.add_argument(
+        "--build-rounds", type=int, default=3, help="dataset builds to time per game"
+    )
+    parser.add_argument("--save-queries", help="write the query mix to this file")
+    parser.add_argument(
+        "--load-queries",
+        help="replay a saved query mix, use the same --chars and --seed",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
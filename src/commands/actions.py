@@ -13,7 +13,7 @@ class Shows:
         self.max_count = 31
         self.max_timespan = 6800
         self.char_limit = 20
-        self.extend_regex = r"^-ex(\d?\.?\d?)?"
+        self.extend_regex = re.compile(r"^-ex(\d?\.?\d?)?")
         self.max_extend = 6.9
 
     def get_max_sequence(self, timestamps, debug=False):
@@ -118,8 +118,10 @@ class Shows:
         """ """
         extend = False
         extend_amount = self.max_extend
-        result = re.search(self.extend_regex, caption)
-        caption = re.sub(self.extend_regex, "", caption).strip()
+        result = self.extend_regex.match(caption)
+        if result:
+            caption = caption[result.end() :]
+        caption = caption.strip()
         # Matched an extend command at the start
         if result:
             extend = True
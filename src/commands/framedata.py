@@ -0,0 +1,278 @@
+#!/usr/bin/python
+import sys
+import json
+import time
+import logging
+from itertools import chain
+from commands.matching import MatchIndex
+from commands.movetable import build_table
+
+
+class FrameDataset:
+    """
+    A fully processed copy of a games frame data along with
+    everything needed to query and revalidate it.
+
+    Datasets are built off to the side by build_dataset and never
+    mutated afterwards, so a refresh can publish a new one by
+    swapping a single reference while readers keep using the one
+    they already hold.
+    """
+
+    def __init__(
+        self,
+        data,
+        char_states,
+        special_states,
+        char_index,
+        detail=None,
+        headers=None,
+        detail_headers=None,
+        table=None,
+    ):
+        self.data = data
+        self.char_states = char_states
+        self.special_states = special_states
+        self.char_index = char_index
+        self.detail = detail
+        self.headers = headers or {}
+        self.detail_headers = detail_headers or {}
+        # MoveTable for queries across every move, None without numpy.
+        self.table = table
+        # Used by anything that caches results derived from a dataset.
+        self.version = time.time_ns()
+
+
+class MoveRecord:
+    """
+    Read only frame data of a single move that can be used like the
+    dict it was built from.
+
+    Moves with the same fields share a single table mapping the field
+    names to positions, so each move only has to keep a tuple of its
+    values instead of a dict of its own.
+    """
+
+    __slots__ = ("fields", "values")
+
+    def __init__(self, fields, values):
+        self.fields = fields
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.fields[key]]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __eq__(self, other):
+        if isinstance(other, MoveRecord):
+            return self.fields == other.fields and self.values == other.values
+        return dict(self.items()) == other
+
+    def __repr__(self):
+        return "MoveRecord(%r)" % dict(self.items())
+
+    def get(self, key, default=None):
+        position = self.fields.get(key)
+        if position is None:
+            return default
+        return self.values[position]
+
+    def keys(self):
+        return self.fields.keys()
+
+    def items(self):
+        return zip(self.fields, self.values)
+
+
+# Field tables shared by every move with the same fields, keyed by
+# the tuple of field names.
+_field_tables = {}
+
+
+def intern_value(value):
+    """
+    Interns strings, including the ones in lists which are turned
+    into tuples, so repeated values like "KD" are only stored once.
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple(intern_value(item) for item in value)
+    return value
+
+
+def decode_move(move):
+    """
+    Returns a MoveRecord of the move with its strings interned and
+    extraInfo decoded if it was sent as a json encoded string.
+    """
+    extra_info = move.get("extraInfo")
+    if isinstance(extra_info, str):
+        move = dict(move)
+        try:
+            move["extraInfo"] = json.loads(extra_info)
+        except ValueError:
+            move["extraInfo"] = [extra_info]
+
+    names = tuple(sys.intern(name) for name in move)
+    fields = _field_tables.get(names)
+    if fields is None:
+        fields = _field_tables.setdefault(
+            names, {name: position for position, name in enumerate(names)}
+        )
+    return MoveRecord(fields, tuple(intern_value(value) for value in move.values()))
+
+
+def lower_moves(moves):
+    """
+    It's possible that the special status moves with the same
+    name are lower cased. To avoid duplication, we enforce that
+    all the moves are lower cased.
+    """
+    return {sys.intern(name.lower()): decode_move(move) for name, move in moves.items()}
+
+
+def get_char_moves(char_states, specific_char_states, char, char_data):
+    """
+    Returns a new copy of the chars moves with lower cased names,
+    along with the normal moves, the state moves and the names of
+    the moves that only exist in a state.
+    """
+    moves = dict(char_data["moves"])
+    moves["normal"] = lower_moves(moves["normal"])
+    char_moves = moves["normal"]
+
+    state_moves = {}
+    specific_states = []
+    if specific_char_states:
+        specific_states = specific_char_states.get(char, [])
+
+    for state in chain(char_states, specific_states):
+        try:
+            moves[state] = lower_moves(char_data["moves"][state])
+        except KeyError:
+            logging.exception(
+                "failed to build specific state info for %s-%s", char, state
+            )
+            continue
+        state_moves.update(moves[state])
+
+    return moves, char_moves, state_moves, set(state_moves) - set(char_moves)
+
+
+def build_reverse_mapping(char_data, char_moves, vt_moves, vt_only_moves):
+    """
+    Create a reverse mapping between common names,
+    move command and the actual name of the moves.
+    """
+    common_name_dict = {}
+    numpad_dict = {}
+    commands_dict = {}
+
+    for move in chain(char_moves.keys(), vt_only_moves):
+        if move == "undefined":
+            continue
+        # Add the common name of the move to the dict.
+        try:
+            common_name = char_moves[move]["cmnName"]
+            common_name_dict[common_name] = move
+        # Some moves dont have common name so just pass.
+        except KeyError:
+            pass
+
+        try:
+            command = char_moves[move]["plnCmd"]
+        except KeyError:
+            try:
+                command = vt_moves[move]["plnCmd"]
+            except KeyError:
+                command = None
+
+        # Add the numpad notation
+        try:
+            numpad_dict[str(char_moves[move]["numCmd"])] = move
+        except KeyError:
+            pass
+        # Wierd edge case where a vt only move has the
+        # same plain command. In this case don't overwrite
+        # the already existing normal command. Depends on
+        # the iteration order being normal moves -> vt moves.
+        if command is None or command in commands_dict:
+            continue
+
+        commands_dict[command] = move
+
+    reverse_mapping = common_name_dict
+    reverse_mapping.update(commands_dict)
+    reverse_mapping.update(numpad_dict)
+    # Also add a set of keys/values with official name
+    reverse_mapping.update(dict(zip(char_moves.keys(), char_moves.keys())))
+    # Update the reverse mapping with vtrigger only moves.
+    reverse_mapping.update(dict(zip(vt_only_moves, vt_only_moves)))
+    # Add the stats of the char to the mapping as well. The extra value
+    # 'char_stat' is added to later determine if the matched move is a
+    # stat or not.
+    reverse_mapping.update(
+        {stat: (value, "char_stat") for stat, value in char_data["stats"].items()}
+    )
+    return reverse_mapping
+
+
+def build_dataset(data, detail, headers=None, detail_headers=None):
+    """
+    Builds a FrameDataset from the frame data dump and the detail
+    endpoint without modifying either of them.
+    """
+    char_states = [state for state in detail["characterStates"] if state != "normal"]
+    specific_char_states = detail["specificCharacterStates"]
+
+    chars = {}
+    for char, char_data in data.items():
+        moves, char_moves, vt_moves, vt_only_moves = get_char_moves(
+            char_states, specific_char_states, char, char_data
+        )
+        processed = dict(char_data)
+        processed["moves"] = moves
+        processed["reverse_mapping"] = build_reverse_mapping(
+            char_data, char_moves, vt_moves, vt_only_moves
+        )
+        # Build the fuzzy match index once here so queries only
+        # have to score a handful of candidates.
+        processed["match_index"] = MatchIndex(processed["reverse_mapping"])
+        chars[char] = processed
+
+    # Handle chars with dots in their names by adding an alias
+    # with the dots stripped out.
+    for char in list(chars):
+        if "." in char:
+            chars[char.replace(".", "")] = chars[char]
+
+    table = build_table(chars)
+
+    return FrameDataset(
+        chars,
+        char_states,
+        specific_char_states if specific_char_states else {},
+        MatchIndex(chars.keys()),
+        detail=detail,
+        headers=headers,
+        detail_headers=detail_headers,
+        table=table,
+    )
+
+
+def load_dataset(body, detail, headers=None, detail_headers=None):
+    """
+    Decodes the raw frame data dump and builds a dataset from it.
+    Takes and returns only picklable values so it can be run in
+    either a thread or a process pool.
+    """
+    return build_dataset(json.loads(body), detail, headers, detail_headers)
@@ -1,23 +1,80 @@
 #!/usr/bin/python
+import os
 import re
-import json
+import mmap
+import time
+import pickle
+import random
+import tempfile
+import asyncio
 import discord
 import logging
 from itertools import chain
 from itertools import islice
 from fuzzywuzzy import process
+from collections import Counter
 from collections import OrderedDict
-from commands.utilities import memoize, get_request, register
+from commands import stats
+from commands.framedata import load_dataset
+from commands.matching import normalize
+from commands.movetable import MAX_LIMIT, parse_query
+from commands.utilities import (
+    LRUCache,
+    memoize,
+    conditional_request,
+    register,
+    run_in_executor,
+)
+
+
+SNAPSHOT_VERSION = 6
+
+
+class FetchError(Exception):
+    """
+    Raised when the frame data endpoints answer with an error, so
+    that the failed fetch isn't memoized like a successful one.
+    """
 
 
 class Frames:
     def __init__(self, config=None):
         config = config or {}
+        self.name = "sfv"
         self.embed_footer_length = 2000
         self.url = config["frame_data"]["sf5_url"]
         self.detail_url = config["frame_data"]["sf5_detail_url"]
-        self.info_regex = r"^-v"
-        self.regex = r"(^\S*)\s*(vt1|vt2)?\s+(.+)"
+        self.refresh_interval = config["frame_data"].get("refresh_interval", 300)
+        self.refresh_jitter = config["frame_data"].get("refresh_jitter", 30)
+        self.refresh_backoff = config["frame_data"].get("refresh_backoff", 30)
+        self.refresh_max_backoff = config["frame_data"].get("refresh_max_backoff", 1800)
+        self.snapshot_dir = config["frame_data"].get("snapshot_dir")
+        # When the snapshot that's being served was written.
+        self.snapshot_mtime = None
+        # Where to decode and index new frame data, one of "thread",
+        # "process" or "none" to do it on the event loop.
+        self.index_executor = config["frame_data"].get("index_executor", "thread")
+        self.index_workers = config["frame_data"].get("index_workers", 1)
+        # Autocomplete fires on nearly every keystroke, so keep recent
+        # suggestions around keyed by the dataset version.
+        self.autocomplete_cache = LRUCache(
+            config["frame_data"].get("autocomplete_cache_size", 4096)
+        )
+        # Seconds autocomplete can spend fuzzy matching before it has
+        # to answer with the best suggestions found so far.
+        self.autocomplete_budget = config["frame_data"].get("autocomplete_budget", 0.5)
+        # Results of recent lookups, including the ones that didn't
+        # match anything, keyed by the normalized query.
+        self.match_cache = LRUCache(config["frame_data"].get("match_cache_size", 4096))
+        # Rendered move responses for the current dataset version.
+        self.render_cache = {}
+        self.render_version = None
+        self.prewarm_renders = config["frame_data"].get("prewarm_renders", False)
+        # The commands shown in the slash command text and embed.
+        self.slash_cmd_type = "numCmd"
+        self.slash_embed_cmd_type = "plnCmd"
+        self.info_regex = re.compile(r"^-v")
+        self.regex = re.compile(r"(^\S*)\s*(vt1|vt2)?\s+(.+)")
         self.char_ratio_thresh = 65
         self.move_ratio_thresh = 65
         self.short_mapping = {
@@ -30,7 +87,7 @@ class Frames:
         }
         # Regex to capture input that starts in the form "cr.", "cr ", "c."
         #  and "c " for cr, st and jp.
-        self.short_regex = r"((^cr|^c)(\s|\.))|((^st|^s)(\s|\.))|((^jp|^j)(\s|\.))"
+        self.short_regex = self.compile_short_regex(self.short_mapping)
         self.output_format = (
             "%s - (%s - %s) - [Startup]: %s [Active]: %s [Recovery]: %s "
             "[On Hit]: %s [On Block]: %s"
@@ -40,7 +97,11 @@ class Frames:
             " [KD Adv]: %s [Quick Rise Adv]: %s [Back Rise Adv]: %s "
         )
 
-        self.vt_mappings = {"1": "vtOne", "2": "vtTwo"}
+        self.vt_mappings = {"1": "vtOne", "2": "vtTwo", "vt1": "vtOne", "vt2": "vtTwo"}
+        self.display_name = "SFV"
+        # Most moves that can be looked up in one command, one embed
+        # can only have 25 fields.
+        self.max_batch_size = 10
         self.custom_fields = [
             "vtc2DashOnHit",
             "runstopOB",
@@ -108,191 +169,399 @@ class Frames:
             "jump": ("bJump", "fJump", "nJump", "bJumpDist", "fJumpDist"),
             "throw": ("throwHurt", "throwRange"),
         }
-        self.request_headers = {}
-        self.previous_data = None
-        self.special_states = {}
+        self.fetch_counts = Counter()
+        self.dataset = None
 
-    def update_headers(self, headers):
-        self.request_headers = {
+    def validators(self, headers):
+        return {
             "etag": headers.get("etag"),
             "Last-Modified": headers.get("Last-Modified"),
         }
 
+    async def conditional_fetch(self, url, validators, parse_json=True):
+        """
+        Fetches the url revalidating with the given validators and
+        counts the outcome as a 200, 304 or error.
+        """
+        try:
+            status, body, headers = await conditional_request(
+                url, validators, parse_json=parse_json
+            )
+        except Exception:
+            self.fetch_counts["error"] += 1
+            raise
+
+        if status in (200, 304):
+            self.fetch_counts[str(status)] += 1
+        else:
+            self.fetch_counts["error"] += 1
+        return status, body, headers
+
+    async def fetch_detail(self, dataset):
+        """
+        Revalidates the detail endpoint against its own validators.
+        Returns its status along with the detail and its validators,
+        which are the ones of the current dataset unless it changed.
+        A 200 with the same detail as before is treated like a 304 in
+        case the endpoint ignores validators.
+        """
+        validators = dataset.detail_headers if dataset else None
+        status, body, headers = await self.conditional_fetch(
+            self.detail_url, validators
+        )
+        if status == 200 and dataset and body == dataset.detail:
+            status = 304
+        if status == 200:
+            return status, body, self.validators(headers)
+        if dataset:
+            return status, dataset.detail, dataset.detail_headers
+        return status, None, {}
+
     async def _get_data(self, **kwargs):
         """
         Simple helper function that hits the frame data dump
-        endpoint and returns the contents in json format.
+        endpoint and builds a new dataset from its contents.
+        Unchanged data (a 304) keeps serving the current dataset
+        without being downloaded or indexed again. Raises FetchError
+        if either endpoint answers with an error.
         """
-        resp, headers = await get_request(
-            self.url,
-            self.request_headers,
+        dataset = self.dataset
+        # Only revalidate once we have data to fall back on.
+        validators = dataset.headers if dataset else None
+        # The dump is decoded along with the indexing in the executor.
+        fetches = [self.conditional_fetch(self.url, validators, parse_json=False)]
+        if self.detail_url:
+            fetches.append(self.fetch_detail(dataset))
+        results = await asyncio.gather(*fetches)
+        status, resp, headers = results[0]
+        detail_status, detail, detail_headers = (
+            results[1] if self.detail_url else (304, None, {})
         )
-        if resp:
-            self.update_headers(headers)
-            detail_resp = None
-            if self.detail_url:
-                detail_resp, _ = await get_request(self.detail_url)
-            self.add_reverse_mapping(resp, detail=detail_resp, **kwargs)
-            self.previous_data = resp
-            return self.previous_data
-        else:
-            return self.previous_data
+
+        if detail_status not in (200, 304):
+            raise FetchError("%s answered with %s" % (self.detail_url, detail_status))
+
+        if status == 304 and detail_status == 200:
+            # The reverse mapping depends on the detail too, so it has to
+            # be rebuilt from a fresh copy of the data.
+            status, resp, headers = await self.conditional_fetch(
+                self.url, None, parse_json=False
+            )
+
+        logging.info("frame data fetch counts for %s: %s", self.name, self.fetch_counts)
+        if status == 200:
+            dataset = await run_in_executor(
+                self.index_executor,
+                self.index_workers,
+                load_dataset,
+                resp,
+                detail,
+                self.validators(headers),
+                detail_headers,
+            )
+            await self.publish(dataset)
+        elif status != 304:
+            raise FetchError("%s answered with %s" % (self.url, status))
+
+        return self.dataset
+
+    async def publish(self, dataset, snapshot=True):
+        """
+        Makes the dataset the one used to answer queries. Readers
+        holding on to the previous one are unaffected by the swap.
+        snapshot=False skips saving it, for datasets another process
+        fetched and already saved.
+        """
+        self.dataset = dataset
+        loop = asyncio.get_running_loop()
+        if snapshot:
+            # Pickling the snapshot is slow enough to keep off the loop.
+            await loop.run_in_executor(None, self.save_snapshot, dataset)
+        if self.prewarm_renders:
+            render_cache = await loop.run_in_executor(
+                None, self.prewarm_render_cache, dataset
+            )
+            if self.dataset is dataset:
+                self.render_cache = render_cache
+                self.render_version = dataset.version
+
+    async def adopt(self, dataset):
+        """
+        Publishes a dataset memoized by another process sharing the
+        cache, unless it's the one already being served. Datasets
+        fetched by this process were published by _get_data.
+        """
+        if dataset is not None and (
+            self.dataset is None or dataset.version != self.dataset.version
+        ):
+            await self.publish(dataset, snapshot=False)
+
+    def snapshot_path(self):
+        if not self.snapshot_dir:
+            return None
+        return os.path.join(self.snapshot_dir, "%s.pickle" % self.name)
+
+    def save_snapshot(self, dataset):
+        """
+        Saves the dataset, which includes the response headers, so
+        that a restart can serve it straight away. The file is
+        written to a temporary file of its own first and then moved
+        in place, so neither a crash nor another process saving at the
+        same time leaves a half written snapshot behind.
+        """
+        path = self.snapshot_path()
+        if not path:
+            return
+
+        snapshot = {"version": SNAPSHOT_VERSION, "dataset": dataset}
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix=".tmp")
+            try:
+                # mkstemp creates it readable by the owner only, the bot
+                # processes reading it may run as another user.
+                os.chmod(tmp_path, 0o644)
+                with os.fdopen(fd, "wb") as snapshot_file:
+                    pickle.dump(
+                        snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL
+                    )
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            logging.exception("failed to save frame data snapshot to %s", path)
+
+    def read_snapshot(self):
+        """
+        Reads the dataset saved by save_snapshot, returning it along
+        with the modification time of the snapshot, or None if there
+        isn't a usable one. The file is memory mapped and unpickled
+        straight from the mapping rather than read into a copy first.
+        """
+        path = self.snapshot_path()
+        if not path or not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "rb") as snapshot_file:
+                mtime = os.fstat(snapshot_file.fileno()).st_mtime_ns
+                with mmap.mmap(
+                    snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+                ) as snapshot_map:
+                    snapshot = pickle.loads(snapshot_map)
+        except Exception:
+            logging.exception("failed to load frame data snapshot from %s", path)
+            return None
+
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            logging.info("ignoring outdated frame data snapshot %s", path)
+            return None
+
+        return mtime, snapshot["dataset"]
+
+    def load_snapshot(self):
+        """
+        Loads the dataset saved by save_snapshot. Returns True if
+        a usable snapshot was found.
+        """
+        snapshot = self.read_snapshot()
+        if snapshot is None:
+            return False
+
+        self.snapshot_mtime, self.dataset = snapshot
+        return True
+
+    def snapshot_changed(self):
+        path = self.snapshot_path()
+        try:
+            return os.stat(path).st_mtime_ns != self.snapshot_mtime
+        except OSError:
+            return False
+
+    async def start(self):
+        """
+        Loads the frame data and starts refreshing it in the background,
+        returning the refresh task. From then on the data already loaded
+        is served while the refresh retries if the load failed. Failures
+        are logged rather than raised so that one bad upstream doesn't
+        stop the other games from loading.
+        """
+        # A snapshot from the last run lets us answer straight away,
+        # it gets revalidated by the refresh loop.
+        restored = self.load_snapshot()
+        if not restored:
+            try:
+                await self.get_data()
+            except Exception:
+                logging.exception("failed to load frame data for %s", self.name)
+        # Errors from the endpoint leave the module without data rather
+        # than raising, either way the refresh loop should back off.
+        failures = 0 if self.ready else 1
+        return asyncio.create_task(
+            self.refresh_loop(revalidate=restored, failures=failures)
+        )
+
+    async def follow_snapshot(self, interval=5):
+        """
+        Serves whatever dataset another process last saved to the
+        snapshot instead of fetching it, checking for a new one every
+        interval seconds. Used by the workers of a sharded bot.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.snapshot_changed():
+                snapshot = await loop.run_in_executor(None, self.read_snapshot)
+                if snapshot is not None:
+                    self.snapshot_mtime, self.dataset = snapshot
+            await asyncio.sleep(interval)
 
     @memoize(300)
     async def get_sf_data(self, **kwargs):
         return await self._get_data(**kwargs)
 
-    async def get_data(self, **kwargs):
+    async def fetch_data(self, **kwargs):
         return await self.get_sf_data(**kwargs)
 
-    def get_char_moves(self, char_states, specific_char_states, char, data):
-        char_moves = {}
-        # It's possible that the special status moves
-        # with the same name are lower cased.
-        # To avoid duplication, we
-        # enforce that all the moves are lower cased.
-        moves = list(data[char]["moves"]["normal"].keys())
-        for m in moves:
-            v = data[char]["moves"]["normal"][m]
-            char_moves[m.lower()] = v
-            data[char]["moves"]["normal"].pop(m)
-            data[char]["moves"]["normal"][m.lower()] = v
-
-        state_moves = {}
-        specific_states = []
-        if specific_char_states:
-            specific_states = specific_char_states.get(char, [])
-
-        for state in chain(char_states, specific_states):
-            try:
-                s_moves = list(data[char]["moves"][state].keys())
-            except KeyError:
-                logging.exception(
-                    "failed to build specific state info for %s-%s", char, state
-                )
-                continue
-            for s_move in s_moves:
-                v = data[char]["moves"][state][s_move]
-                state_moves[s_move.lower()] = v
-                data[char]["moves"][state].pop(s_move)
-                data[char]["moves"][state][s_move.lower()] = v
-
-        return char_moves, state_moves, set(state_moves) - set(char_moves)
-
-    def add_reverse_mapping(self, data, detail=None, **kwargs):
-        """
-        Create a reverse mapping between common names,
-        move command and the actual name of the moves.
-        Increases the time on the first queury but the result
-        is cached for subsequent ones.
-        """
-        common_name_dict = {}
-        numpad_dict = {}
-        commands_dict = {}
-        char_states = detail["characterStates"]
-        specific_char_states = detail["specificCharacterStates"]
-        char_states.remove("normal")
-
-        self.special_states = specific_char_states if specific_char_states else {}
-        self.char_states = char_states
-        # Handle chars with dots in their names by creating
-        # a copy with the dots stripped out.
-        update = []
-        for char in data.keys():
-            if "." in char:
-                update.append(char)
-        for char in update:
-            data[char.replace(".", "")] = data[char]
-
-        for char in data.keys():
-
-            char_moves, vt_moves, vt_only_moves = self.get_char_moves(
-                char_states, specific_char_states, char, data
-            )
-
-            for move in chain(char_moves.keys(), vt_only_moves):
-                if move == "undefined":
-                    continue
-                # Add the common name of the move to the dict.
-                try:
-                    common_name = char_moves[move]["cmnName"]
-                    common_name_dict[common_name] = move
-                # Some moves dont have common name so just pass.
-                except KeyError:
-                    pass
+    @property
+    def ready(self):
+        """
+        Whether frame data has been loaded and commands can be served.
+        """
+        return self.dataset is not None
 
-                try:
-                    command = char_moves[move]["plnCmd"]
-                except KeyError:
-                    try:
-                        command = vt_moves[move]["plnCmd"]
-                    except KeyError:
-                        pass
+    @stats.timed("fetch")
+    async def get_data(self, **kwargs):
+        """
+        Returns the last good copy of the frame data straight away,
+        only waiting on the endpoint if nothing has been loaded yet.
+        Keeping it fresh is left to refresh_loop.
+        """
+        if self.dataset is not None:
+            return self.dataset
+        try:
+            dataset = await self.fetch_data(**kwargs)
+        except FetchError as e:
+            logging.warning("failed to load frame data: %s", e)
+            return None
+        # A warm shared cache hands back another process's dataset.
+        await self.adopt(dataset)
+        return self.dataset
+
+    def next_refresh_delay(self, failures):
+        """
+        Returns how long to wait before the next refresh. Failed
+        refreshes are retried with exponential backoff and jitter is
+        added so the games don't all refresh at the same moment.
+        """
+        if failures:
+            delay = min(
+                self.refresh_backoff * 2 ** (failures - 1), self.refresh_max_backoff
+            )
+        else:
+            delay = self.refresh_interval
+        return delay + random.uniform(0, self.refresh_jitter)
 
-                # Add the numpad notation
-                try:
-                    numpad_dict[str(char_moves[move]["numCmd"])] = move
-                except KeyError:
-                    pass
-                # Wierd edge case where a vt only move has the
-                # same plain command. In this case don't overwrite
-                # the already existing normal command. Depends on
-                # the iteration order being normal moves -> vt moves.
-                if command in commands_dict:
-                    continue
+    async def refresh_loop(self, revalidate=False, failures=0):
+        """
+        Periodically refetches the frame data in the background so
+        that commands never have to wait on the endpoint. Passing
+        revalidate=True refreshes straight away, which is used to
+        check data loaded from a snapshot, and failures is the number
+        of failed attempts so far to back off from.
+        """
+        while True:
+            if revalidate:
+                revalidate = False
+            else:
+                await asyncio.sleep(self.next_refresh_delay(failures))
+            errors = self.fetch_counts["error"]
+            try:
+                with stats.span("refresh"):
+                    # Another bot process sharing the cache might have
+                    # refreshed recently, in which case its copy is
+                    # used instead of hitting the endpoint again.
+                    data = await self.fetch_data(
+                        # Failed refreshes aren't cached, but still skip
+                        # the cache while backing off from them.
+                        no_cache=bool(failures),
+                        max_age=self.refresh_interval / 2,
+                    )
+                    await self.adopt(data)
+            except FetchError as e:
+                logging.warning("failed to refresh frame data: %s", e)
+                data = None
+            except Exception:
+                logging.exception("failed to refresh frame data from %s", self.url)
+                data = None
+
+            if data is None or self.fetch_counts["error"] > errors:
+                failures += 1
+            else:
+                failures = 0
 
-                commands_dict[command] = move
-
-            common_name_dict.update(commands_dict)
-            common_name_dict.update(numpad_dict)
-            data[char]["reverse_mapping"] = common_name_dict
-            # Also add a set of keys/values with official name
-            offical_names = dict(zip(char_moves.keys(), char_moves.keys()))
-            data[char]["reverse_mapping"].update(offical_names)
-            # Update the reverse mapping with vtrigger only moves.
-            data[char]["reverse_mapping"].update(
-                dict(zip(vt_only_moves, vt_only_moves))
-            )
-            # Add the stats of the char to the mapping as well. The extra value
-            # 'char_stat' is added to later determine if the matched move is a
-            # stat or not.
-            stats_mapping = {
-                stat: (value, "char_stat")
-                for stat, value in data[char]["stats"].items()
-            }
+    def match_char(self, char, dataset):
+        """
+        Returns the name of the char that best matches, or None if
+        nothing matches well enough.
+        """
+        char_match, char_ratio = dataset.char_index.extract_one(char)
+        if char_ratio < self.char_ratio_thresh:
+            return None
+        return char_match
 
-            data[char]["reverse_mapping"].update(stats_mapping)
+    def compile_short_regex(self, short_mapping):
+        """
+        Compiles a regex that matches any of the short forms followed
+        by a "." or whitespace at the start of a move. Longer forms go
+        first so "cr." isn't read as "c". Returns None if the game
+        doesn't have any short forms.
+        """
+        if not short_mapping:
+            return None
+        forms = sorted(short_mapping, key=len, reverse=True)
+        return re.compile(r"^(%s)[\s.]" % "|".join(map(re.escape, forms)))
 
-            common_name_dict = {}
-            commands_dict = {}
-            numpad_dict = {}
+    def expand_short_form(self, move):
+        """
+        They might have supplied the move name in shortened format
+        so convert it to how the frame data dump expects.
+        """
+        if self.short_regex is None:
+            return move
+        result = self.short_regex.match(move)
+        if not result:
+            return move
+        return self.short_mapping[result.group(1)] + move[result.end() :]
 
-    def match_move(self, char, move, state, data):
+    def match_key(self, char, move, state, dataset):
         """
-        Main helper function that handles matching the move.
-        Uses the reverse mapping of the common name, input command
-        and short form converter to increase the chances of a better
-        match.
+        Returns the match cache key for a query. The names are keyed
+        normalized since that's all the matching looks at.
         """
-        # First find the char they want.
-        char_match, char_ratio = process.extractOne(char, data.keys())
-        if char_ratio < self.char_ratio_thresh:
-            return False
+        return (dataset.version, normalize(char), normalize(move), state or None)
 
-        # They might have supplied the move name in shortened format
-        # so convert it to how the frame data dump expects.
-        if self.short_regex:
-            result = re.search(self.short_regex, move)
-            if result:
-                matched = result.group(0)
-                # Slice to the second last char because the matched move might
-                # be 'cr. 'or 'cr ' but the  mapping only contains cr.
-                move = re.sub(self.short_regex, self.short_mapping[matched[:-1]], move)
+    def query_key(self, char, move):
+        """
+        Returns a key that's the same for queries that will match and
+        be rendered the same way, whatever their case or punctuation.
+        """
+        return (
+            normalize(char),
+            normalize(move),
+            normalize(self.expand_short_form(move)),
+        )
 
+    def match_char_move(self, char_match, move, state, dataset):
+        """
+        Matches the move of an already matched char, see match_move.
+        The move should already have its short form expanded.
+        """
+        data = dataset.data
         # Use the reverse mapping to determine which move they
         # were looking for.
-        moves = data[char_match]["reverse_mapping"]
-        move_match, move_ratio = process.extractOne(move, moves.keys())
+        move_index = data[char_match]["match_index"]
+        move_match, move_ratio = move_index.extract_one(move)
 
         if move_ratio < self.move_ratio_thresh:
             return False
@@ -302,37 +571,116 @@ class Frames:
         # Check if the matched name was a char stat or a move.
         if "char_stat" in move:
             return char_match, move_match, move
+
+        move_data = self.lookup_move(dataset, char_match, move, state)
+        if move_data is None:
+            return False
+        return char_match, move, move_data
+
+    @stats.timed("match")
+    def match_move(self, char, move, state, dataset):
+        """
+        Main helper function that handles matching the move.
+        Uses the reverse mapping of the common name, input command
+        and short form converter to increase the chances of a better
+        match. Results, including failed matches, are cached for
+        the dataset.
+        """
+        move = self.expand_short_form(move)
+        key = self.match_key(char, move, state, dataset)
+        matched_value = self.match_cache.get(key)
+        if matched_value is not None:
+            return matched_value
+
+        # First find the char they want.
+        char_match = self.match_char(char, dataset)
+        if char_match is None:
+            matched_value = False
         else:
-            # Find the move they want.
-            if state:
-                # The move might not have any difference in vtrigger
-                # so just return the normal version.
-                try:
-                    move_data = data[char_match]["moves"][state][move]
-                except KeyError:
-                    move_data = data[char_match]["moves"]["normal"][move]
-            else:
-                try:
-                    move_data = data[char_match]["moves"]["normal"][move]
-                # Might be a special status only move.
-                except KeyError:
-                    if self.char_states:
-                        for state in self.char_states:
-                            try:
-                                move_data = data[char_match]["moves"][state][move]
-                                break
-                            except KeyError:
-                                pass
-
-                    elif self.special_states:
-                        for state in self.special_states[char_match]:
-                            try:
-                                move_data = data[char_match]["moves"][state][move]
-                                break
-                            except KeyError:
-                                pass
-
-            return char_match, move, move_data
+            matched_value = self.match_char_move(char_match, move, state, dataset)
+        self.match_cache.set(key, matched_value)
+        return matched_value
+
+    def match_batch(self, char, move, state, dataset):
+        """
+        Matches every combination of the comma separated chars and
+        moves, each char only being matched once. Returns a list of
+        (char, move, matched_value) tuples where matched_value is
+        False for failed matches, or None if it isn't a batch.
+        """
+        if "," not in char and "," not in move:
+            return None
+
+        chars = [name.strip() for name in char.split(",") if name.strip()]
+        moves = [name.strip() for name in move.split(",") if name.strip()]
+        if not chars or not moves:
+            return None
+
+        if len(chars) == 1 and len(moves) > 1:
+            # Some commands have commas in them, like target combos,
+            # so prefer a move that matches the whole thing exactly.
+            char_match = self.match_char(chars[0], dataset)
+            if char_match is not None:
+                move_index = dataset.data[char_match]["match_index"]
+                if normalize(move) in move_index.exact:
+                    return None
+
+        # Only real batches are timed here, anything else is timed by
+        # match_move so every query records a single match.
+        with stats.span("match"):
+            matches = []
+            for char_name in chars:
+                char_match = None
+                for move_name in moves[: self.max_batch_size - len(matches)]:
+                    expanded = self.expand_short_form(move_name)
+                    key = self.match_key(char_name, expanded, state, dataset)
+                    matched_value = self.match_cache.get(key)
+                    if matched_value is None:
+                        if char_match is None:
+                            char_match = self.match_char(char_name, dataset) or False
+                        matched_value = char_match and self.match_char_move(
+                            char_match, expanded, state, dataset
+                        )
+                        self.match_cache.set(key, matched_value)
+                    matches.append((char_name, move_name, matched_value))
+        return matches
+
+    def lookup_move(self, dataset, char, move, state):
+        """
+        Finds the data of the move for the given state, returning
+        None if the char doesn't have it.
+        """
+        moves = dataset.data[char]["moves"]
+        move_data = None
+        if state:
+            # The move might not have any difference in vtrigger
+            # so just return the normal version.
+            try:
+                move_data = moves[state][move]
+            except KeyError:
+                move_data = moves["normal"].get(move)
+        else:
+            try:
+                move_data = moves["normal"][move]
+            # Might be a special status only move.
+            except KeyError:
+                if dataset.char_states:
+                    for state in dataset.char_states:
+                        try:
+                            move_data = moves[state][move]
+                            break
+                        except KeyError:
+                            pass
+
+                elif dataset.special_states:
+                    for state in dataset.special_states.get(char, []):
+                        try:
+                            move_data = moves[state][move]
+                            break
+                        except KeyError:
+                            pass
+
+        return move_data
 
     def format_stats_output(self, char, move, move_data, data, searched_move):
         match, ratio = process.extractOne(searched_move, self.stats_mapping.keys())
@@ -432,10 +780,9 @@ class Frames:
                     name=field_mapping[field], value=self.escape_chars(data[field])
                 )
 
+        # extraInfo is decoded when the dataset is built in case they
+        # messed up the encoding.
         if "extraInfo" in data:
-            # Maybe they messed up the encoding so attempt to handle it.
-            if type(data["extraInfo"]) == str:
-                data["extraInfo"] = json.loads(data["extraInfo"])
             presented_info = ", ".join(data["extraInfo"])
             if len(presented_info) > self.embed_footer_length:
                 presented_info = presented_info[:self.embed_footer_length] + " ..."
@@ -457,8 +804,6 @@ class Frames:
         )
 
         if "extraInfo" in data:
-            if type(data["extraInfo"]) == str:
-                data["extraInfo"] = json.loads(data["extraInfo"])
             info = " ```%s``` " % ", ".join(data["extraInfo"])
             text_output = text_output + info
 
@@ -467,6 +812,143 @@ class Frames:
 
         return text_output, embed_output
 
+    def render_move(self, char, move, state, data, cmd_type, embed_cmd_type, verbose):
+        text_output = self.format_output(
+            char, move, state, data, None, move, cmd_type=cmd_type
+        )
+        if not verbose:
+            return text_output
+        embed_output = self.format_embeded_message(
+            char, move, state, data, cmd_type=embed_cmd_type
+        )
+        return self.add_custom_fields(data, text_output, embed_output)
+
+    @stats.timed("render")
+    def render(
+        self,
+        dataset,
+        matched_value,
+        state,
+        searched_move,
+        cmd_type="plnCmd",
+        embed_cmd_type="plnCmd",
+        verbose=True,
+    ):
+        """
+        Renders the response for a matched move. Move responses only
+        depend on the dataset and what was matched, so they're cached
+        until a new dataset is published. The cached embeds are shared
+        between responses and must not be modified.
+        """
+        char, move, data = matched_value
+        if "char_stat" in data:
+            return self.format_output(
+                char, move, state, data, dataset.data, searched_move, cmd_type=cmd_type
+            )
+
+        args = (char, move, state, data, cmd_type, embed_cmd_type, verbose)
+        if dataset.version != self.render_version:
+            if dataset is not self.dataset:
+                # Don't let a reader of an older dataset reset the cache.
+                return self.render_move(*args)
+            self.render_cache = {}
+            self.render_version = dataset.version
+
+        # Strive passes vtrigger=False for no state, which renders the
+        # same as the None the cache is prewarmed with.
+        key = (char, move, state or None, cmd_type, embed_cmd_type, verbose)
+        if key not in self.render_cache:
+            self.render_cache[key] = self.render_move(*args)
+        return self.render_cache[key]
+
+    def render_batch(
+        self,
+        dataset,
+        matches,
+        state,
+        cmd_type="plnCmd",
+        embed_cmd_type="plnCmd",
+        verbose=True,
+    ):
+        """
+        Renders the response for a batch of matches as a single
+        message, with one line and embed field per move.
+        """
+        lines = []
+        em = discord.Embed(
+            title=", ".join(
+                dict.fromkeys(value[0] for _, _, value in matches if value)
+            ),
+            colour=0x3998C6,
+        )
+        for char_name, move_name, matched_value in matches:
+            if not matched_value:
+                line = (
+                    "%s with %s is not a valid character/move combination for %s."
+                ) % (char_name, move_name, self.display_name)
+                lines.append(line)
+                em.add_field(name="%s %s" % (char_name, move_name), value=line)
+                continue
+
+            char, move, data = matched_value
+            line = self.render(
+                dataset,
+                matched_value,
+                state,
+                move_name,
+                cmd_type=cmd_type,
+                embed_cmd_type=embed_cmd_type,
+                verbose=False,
+            )
+            lines.append(line)
+            if "char_stat" in data:
+                em.add_field(name="%s %s" % (char, move), value=line, inline=False)
+                continue
+
+            fields = [
+                ("startup", "Startup"),
+                ("active", "Active"),
+                ("recovery", "Recovery"),
+                ("onHit", "On Hit"),
+                ("onBlock", "On Block"),
+            ]
+            em.add_field(
+                name="%s - %s (%s)" % (char, move, data.get(embed_cmd_type, "-")),
+                value=" | ".join(
+                    "%s: %s" % (label, self.escape_chars(data[field]))
+                    for field, label in fields
+                    if field in data
+                )
+                or "-",
+                inline=False,
+            )
+
+        text_output = "\n".join(lines)
+        if not verbose:
+            return text_output
+        return text_output, em
+
+    def prewarm_render_cache(self, dataset):
+        """
+        Renders the slash command response for every move of every
+        char in the dataset. Returns a new render cache rather than
+        filling the current one so it can be run in an executor.
+        """
+        render_cache = {}
+        cmd_type, embed_cmd_type = self.slash_cmd_type, self.slash_embed_cmd_type
+        for char, char_data in dataset.data.items():
+            moves = set(chain.from_iterable(char_data["moves"].values()))
+            for move in moves:
+                # Only prewarm what a query without a state would get.
+                data = self.lookup_move(dataset, char, move, None)
+                if data is None:
+                    continue
+                key = (char, move, None, cmd_type, embed_cmd_type, True)
+                render_cache[key] = self.render_move(
+                    char, move, None, data, cmd_type, embed_cmd_type, True
+                )
+        return render_cache
+
     @register("frames")
     async def get_frames(self, msg, user, *args, **kwargs):
         """
@@ -476,11 +958,11 @@ class Frames:
         """
         # Check if they want verbose output.
         verbose = False
-        info_result = re.search(self.info_regex, msg)
+        info_result = self.info_regex.match(msg)
         if info_result:
             verbose = True
-            msg = re.sub(self.info_regex, "", msg).strip()
-        result = re.search(self.regex, msg)
+            msg = msg[info_result.end() :].strip()
+        result = self.regex.search(msg)
 
         if not result:
             return (
@@ -499,24 +981,22 @@ class Frames:
             vtrigger = False
 
         frame_data = await self.get_data(**kwargs)
-        if not frame_data:
+        if frame_data is None:
             return "Got an error when trying to get frame data :(."
 
+        matches = self.match_batch(char_name, move_name, vtrigger, frame_data)
+        if matches:
+            return self.render_batch(frame_data, matches, vtrigger, verbose=verbose)
+
         matched_value = self.match_move(char_name, move_name, vtrigger, frame_data)
         if not matched_value:
             return (
                 "%s with %s is not a valid " "character/move combination for SFV."
             ) % (char_name, move_name)
         else:
-            char, move, data = matched_value
-            text_output = self.format_output(
-                char, move, vtrigger, data, frame_data, move_name
+            return self.render(
+                frame_data, matched_value, vtrigger, move_name, verbose=verbose
             )
-            if verbose and "char_stat" not in data:
-                embed_output = self.format_embeded_message(char, move, vtrigger, data)
-                return self.add_custom_fields(data, text_output, embed_output)
-            else:
-                return text_output
 
     @register("sfv")
     async def _get_frames(self, *args, **kwargs):
@@ -524,89 +1004,217 @@ class Frames:
 
     async def slash_sfv(self, char_name, move_name, vt, **kwargs):
         frame_data = await self.get_data(**kwargs)
-        if not frame_data:
+        if frame_data is None:
             return "Got an error when trying to get frame data :(."
 
         if vt:
             vt = self.vt_mappings[vt]
 
+        matches = self.match_batch(char_name, move_name, vt, frame_data)
+        if matches:
+            return self.render_batch(
+                frame_data,
+                matches,
+                vt,
+                cmd_type=self.slash_cmd_type,
+                embed_cmd_type=self.slash_embed_cmd_type,
+            )
+
         matched_value = self.match_move(char_name, move_name, vt, frame_data)
         if not matched_value:
             return (
                 "%s with %s is not a valid " "character/move combination for SFV."
             ) % (char_name, move_name)
         else:
-            char, move, data = matched_value
-            text_output = self.format_output(
-                char, move, vt, data, frame_data, move_name, cmd_type="numCmd"
+            return self.render(
+                frame_data,
+                matched_value,
+                vt,
+                move_name,
+                cmd_type=self.slash_cmd_type,
+                embed_cmd_type=self.slash_embed_cmd_type,
             )
-            if "char_stat" not in data:
-                embed_output = self.format_embeded_message(char, move, vt, data)
-                return self.add_custom_fields(data, text_output, embed_output)
-            return text_output
 
-    async def autocomplete_char(self, name):
-        data = await self.get_data()
+    async def query_moves(self, query):
+        """
+        Answers questions across the whole roster like
+        "startup<=4 onblock>=2" using the datasets move table.
+        """
+        dataset = await self.get_data()
+        if dataset is None:
+            return "Got an error when trying to get frame data :(."
+        if dataset.table is None:
+            return "Move queries aren't available right now."
+
+        try:
+            parsed = parse_query(query)
+        except ValueError as e:
+            return (
+                "%s. Try something like startup<=4 onblock>=-2 "
+                'char="dee jay" sort=startup limit=%s' % (e, MAX_LIMIT)
+            )
+
+        char = parsed["char"]
+        if char is not None:
+            char, char_ratio = dataset.char_index.extract_one(char)
+            if char_ratio < self.char_ratio_thresh:
+                return "Couldn't find a character called %s." % parsed["char"]
+
+        state = self.vt_mappings.get(parsed["state"].lower(), parsed["state"])
+        states = {name.lower(): name for name in dataset.table.states}
+        state = states.get(state.lower(), state)
+        if state not in dataset.table.states:
+            return "There's no %s state, try one of %s." % (
+                parsed["state"],
+                ", ".join(dataset.table.states),
+            )
+
+        rows = dataset.table.select(
+            parsed["filters"],
+            char=char,
+            state=state,
+            sort=parsed["sort"],
+            limit=parsed["limit"],
+        )
+        if not rows:
+            return "No moves matched %s." % query
+
+        lines = []
+        for char, state, move in rows:
+            move_data = dataset.data[char]["moves"][state][move]
+            lines.append(
+                "%s - %s (%s) - [Startup]: %s [On Hit]: %s [On Block]: %s"
+                % tuple(
+                    self.escape_chars(value)
+                    for value in (
+                        char,
+                        move,
+                        move_data.get(self.slash_cmd_type, "-"),
+                        move_data.get("startup", "-"),
+                        move_data.get("onHit", "-"),
+                        move_data.get("onBlock", "-"),
+                    )
+                )
+            )
+        return "\n".join(lines)
+
+    def suggest(self, index, name, ratio_thresh, limit=5, deadline=None):
+        """
+        Returns suggestions for a partially typed name. Names that
+        start with what was typed are preferred and fuzzy matching
+        is only used when there are none.
+        """
+        suggestions = index.prefix(name, limit)
+        if suggestions:
+            return suggestions
+        return [
+            choice for (choice, _) in index.extract(name, limit, ratio_thresh, deadline)
+        ]
 
-        if not data:
+    def cache_suggestions(self, key, suggestions, deadline):
+        """
+        Caches suggestions unless they were cut short by the deadline
+        and might be missing better matches.
+        """
+        if time.perf_counter() <= deadline:
+            self.autocomplete_cache.set(key, suggestions)
+
+    # Discord throws away late autocomplete responses, so these only use
+    # the data that's already loaded, never fetching it, and stop fuzzy
+    # matching once the time budget runs out.
+
+    async def autocomplete_char(self, name):
+        dataset = self.dataset
+        if dataset is None:
             return []
 
+        data = dataset.data
+
         if not name:
             return list(islice(data.keys(), 5))
 
-        return [
-            char
-            for (char, ratio) in process.extract(name, data.keys())
-            if ratio > self.char_ratio_thresh
-        ]
+        key = (dataset.version, self.name, None, name)
+        suggestions = self.autocomplete_cache.get(key)
+        if suggestions is None:
+            deadline = time.perf_counter() + self.autocomplete_budget
+            suggestions = self.suggest(
+                dataset.char_index, name, self.char_ratio_thresh, deadline=deadline
+            )
+            self.cache_suggestions(key, suggestions, deadline)
+        return suggestions
 
     async def autocomplete_move(self, char_name, move_name):
-        data = await self.get_data()
-        if not data:
+        dataset = self.dataset
+        if dataset is None:
             return []
 
+        key = (dataset.version, self.name, char_name, move_name)
+        suggestions = self.autocomplete_cache.get(key)
+        if suggestions is not None:
+            return suggestions
+
+        deadline = time.perf_counter() + self.autocomplete_budget
         try:
-            char_match, _ = process.extractOne(char_name, data.keys())
-            moves = data[char_match]["reverse_mapping"]
+            char_match, _ = dataset.char_index.extract_one(char_name)
+            char_data = dataset.data[char_match]
         except KeyError:
             return []
 
         if not move_name:
-            return list(islice(moves.keys(), 5))
-
-        return [
-            move
-            for (move, ratio) in process.extract(move_name, moves.keys())
-            if ratio > self.move_ratio_thresh
-        ]
+            suggestions = list(islice(char_data["reverse_mapping"].keys(), 5))
+        else:
+            suggestions = self.suggest(
+                char_data["match_index"],
+                move_name,
+                self.move_ratio_thresh,
+                deadline=deadline,
+            )
+        self.cache_suggestions(key, suggestions, deadline)
+        return suggestions
 
     async def autocomplete_char_state(self, char_name, _):
-        data = await self.get_data()
-        if not data:
+        dataset = self.dataset
+        if dataset is None:
             return []
 
-        return self.special_states.get(char_name)
+        return dataset.special_states.get(char_name, [])
 
 
 class GGFrames(Frames):
     def __init__(self, config):
         super().__init__(config)
+        self.name = "ggst"
+        self.display_name = "GGST"
         self.url = config["frame_data"]["ggst_url"]
         self.detail_url = config["frame_data"]["ggst_detail_url"]
+        # Strive moves are looked up by their numpad notation so
+        # there are no short forms to expand.
+        self.short_mapping = {}
         self.short_regex = None
+        self.slash_embed_cmd_type = "numCmd"
 
     @memoize(300)
     async def get_gg_data(self, **kwargs):
         return await self._get_data(**kwargs)
 
-    async def get_data(self):
-        return await self.get_gg_data()
+    async def fetch_data(self, **kwargs):
+        return await self.get_gg_data(**kwargs)
 
     async def slash_strive(self, char_name, move_name, *args, **kwargs):
         vtrigger = False
         frame_data = await self.get_data()
-        if not frame_data:
+        if frame_data is None:
             return "Got an error when trying to get frame data :(."
+
+        matches = self.match_batch(char_name, move_name, vtrigger, frame_data)
+        if matches:
+            return self.render_batch(
+                frame_data,
+                matches,
+                vtrigger,
+                cmd_type=self.slash_cmd_type,
+                embed_cmd_type=self.slash_embed_cmd_type,
+            )
         matched_value = self.match_move(char_name, move_name, vtrigger, frame_data)
 
         if not matched_value:
@@ -614,36 +1222,47 @@ class GGFrames(Frames):
                 "%s with %s is not a valid " "character/move combination for GGST"
             ) % (char_name, move_name)
         else:
-            char, move, data = matched_value
-            text_output = self.format_output(
-                char, move, vtrigger, data, frame_data, move_name, cmd_type="numCmd"
+            return self.render(
+                frame_data,
+                matched_value,
+                vtrigger,
+                move_name,
+                cmd_type=self.slash_cmd_type,
+                embed_cmd_type=self.slash_embed_cmd_type,
             )
-            if "char_stat" not in data:
-                embed_output = self.format_embeded_message(
-                    char, move, vtrigger, data, cmd_type="numCmd"
-                )
-                return self.add_custom_fields(data, text_output, embed_output)
-            return text_output
 
 
 class SF6Frames(Frames):
     def __init__(self, config):
         super().__init__(config)
+        self.name = "sf6"
+        self.display_name = "SF6"
         self.url = config["frame_data"]["sf6_url"]
         self.detail_url = config["frame_data"]["sf6_detail_url"]
+        self.slash_embed_cmd_type = "numCmd"
 
     @memoize(300)
     async def get_sf6_data(self, **kwargs):
         return await self._get_data(**kwargs)
 
-    async def get_data(self, **kwargs):
-        return await self.get_sf6_data()
+    async def fetch_data(self, **kwargs):
+        return await self.get_sf6_data(**kwargs)
 
     async def slash_sf6(self, char_name, move_name, state, **kwargs):
         frame_data = await self.get_data()
-        if not frame_data:
+        if frame_data is None:
             return "Got an error when trying to get frame data :(."
 
+        matches = self.match_batch(char_name, move_name, state, frame_data)
+        if matches:
+            return self.render_batch(
+                frame_data,
+                matches,
+                state,
+                cmd_type=self.slash_cmd_type,
+                embed_cmd_type=self.slash_embed_cmd_type,
+            )
+
         matched_value = self.match_move(char_name, move_name, state, frame_data)
 
         if not matched_value:
@@ -651,13 +1270,11 @@ class SF6Frames(Frames):
                 "%s with %s is not a valid " "character/move combination for SF6"
             ) % (char_name, move_name)
         else:
-            char, move, data = matched_value
-            text_output = self.format_output(
-                char, move, state, data, frame_data, move_name, cmd_type="numCmd"
+            return self.render(
+                frame_data,
+                matched_value,
+                state,
+                move_name,
+                cmd_type=self.slash_cmd_type,
+                embed_cmd_type=self.slash_embed_cmd_type,
             )
-            if "char_stat" not in data:
-                embed_output = self.format_embeded_message(
-                    char, move, state, data, cmd_type="numCmd"
-                )
-                return self.add_custom_fields(data, text_output, embed_output)
-            return text_output
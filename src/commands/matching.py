@@ -0,0 +1,299 @@
+#!/usr/bin/python
+import sys
+import time
+import bisect
+import heapq
+from collections import Counter, defaultdict
+from fuzzywuzzy import fuzz, utils
+
+
+def normalize(value):
+    """
+    Normalizes a string the same way fuzzywuzzy's extract functions
+    do before scoring, so scores against the normalized strings are
+    identical to scoring the raw ones.
+    """
+    return utils.full_process(utils.full_process(value), force_ascii=True)
+
+
+def ngrams(value, size=3):
+    """
+    Returns the set of padded n-grams of a normalized string. Padding
+    makes sure that short strings like '5p' still produce grams.
+    """
+    padded = " %s " % value
+    if len(padded) <= size:
+        return {padded}
+    return {sys.intern(padded[i : i + size]) for i in range(len(padded) - size + 1)}
+
+
+def profile(processed):
+    """
+    Returns what wratio_bound needs to know about a normalized string,
+    its length, the counts of its characters besides spaces, the number
+    of spaces and its tokens.
+    """
+    counts = Counter(processed)
+    spaces = counts.pop(" ", 0)
+    tokens = processed.split()
+    return len(processed), counts, spaces, tokens
+
+
+def ratio_bound(common, first_length, second_length):
+    """
+    Upper bound of fuzz.ratio for strings sharing common characters,
+    counting repeats. It's twice the matched characters over the total
+    length and no alignment can match more than the shared ones.
+    """
+    return utils.intr(100 * 2 * common / (first_length + second_length))
+
+
+def partial_ratio_bound(common, first_length, second_length):
+    """
+    Upper bound of fuzz.partial_ratio. The best window of the longer
+    string can't match more than the shared characters, and the ratio
+    of the shorter string against a window no longer than itself peaks
+    when the window is exactly that many characters.
+    """
+    bound = 2 * common / (min(first_length, second_length) + common)
+    return 100 if bound > 0.995 else utils.intr(100 * bound)
+
+
+def wratio_bound(query_profile, processed):
+    """
+    Upper bound of fuzz.WRatio of the query, given by its profile,
+    against a normalized string. It's built from bounds of each of the
+    ratios WRatio takes the best of using only the characters the
+    strings share, which is much cheaper than scoring them.
+    """
+    length, counts, spaces, tokens = query_profile
+    other_length, other_counts, other_spaces, other_tokens = profile(processed)
+    shared = sum(min(count, other_counts[char]) for char, count in counts.items())
+
+    # The token ratios join the sorted tokens with single spaces.
+    sorted_length = length - spaces + len(tokens) - 1
+    other_sorted_length = other_length - other_spaces + len(other_tokens) - 1
+    sorted_shared = shared + min(len(tokens), len(other_tokens)) - 1
+    unique, other_unique = set(tokens), set(other_tokens)
+    # Shared tokens can make the token set ratio 100, otherwise it
+    # compares the same strings as the token sort ratio unless a
+    # token is repeated.
+    same_as_sort = (
+        not unique & other_unique
+        and len(unique) == len(tokens)
+        and len(other_unique) == len(other_tokens)
+    )
+
+    base = ratio_bound(shared + min(spaces, other_spaces), length, other_length)
+    len_ratio = max(length, other_length) / min(length, other_length)
+    if len_ratio < 1.5:
+        token_sort = ratio_bound(sorted_shared, sorted_length, other_sorted_length)
+        token_set = token_sort if same_as_sort else 100
+        return utils.intr(max(base, token_sort * 0.95, token_set * 0.95))
+
+    partial_scale = 0.6 if len_ratio > 8 else 0.9
+    partial = partial_ratio_bound(
+        shared + min(spaces, other_spaces), length, other_length
+    )
+    token_sort = partial_ratio_bound(sorted_shared, sorted_length, other_sorted_length)
+    token_set = token_sort if same_as_sort else 100
+    return utils.intr(
+        max(
+            base,
+            partial * partial_scale,
+            token_sort * 0.95 * partial_scale,
+            token_set * 0.95 * partial_scale,
+        )
+    )
+
+
+def length_bound(processed_query, processed):
+    """
+    Upper bound of fuzz.WRatio from the lengths of the strings alone,
+    checked before the tighter but slower wratio_bound.
+    """
+    shortest = min(len(processed_query), len(processed))
+    longest = max(len(processed_query), len(processed))
+    base = utils.intr(100 * 2 * shortest / (shortest + longest))
+    if longest / shortest < 1.5:
+        return max(base, 95)
+    return max(base, utils.intr(100 * (0.6 if longest / shortest > 8 else 0.9)))
+
+
+class MatchIndex:
+    """
+    Precomputed index over a fixed collection of names that answers
+    the same questions as process.extractOne without scoring every
+    choice on each query.
+
+    Lookups first try an exact match on the normalized name, then
+    score the choices that share an n-gram with the query, which
+    always includes every choice the query is a prefix of. The rest
+    are only scored if an upper bound of their score says they could
+    still beat the best candidate, so results are identical to a full
+    extractOne scan.
+    """
+
+    def __init__(self, choices, ngram_size=3):
+        self.choices = list(choices)
+        # Names like "stand lp" are shared by most chars, so intern
+        # them and the grams to only keep one copy around.
+        self.processed = [sys.intern(normalize(choice)) for choice in self.choices]
+        self.ngram_size = ngram_size
+        self.exact = {}
+        grams = defaultdict(list)
+
+        for position, processed in enumerate(self.processed):
+            # Keep the first choice for each normalized name since
+            # extractOne returns the first of equally scored matches.
+            self.exact.setdefault(processed, position)
+            for gram in ngrams(processed, ngram_size):
+                grams[gram].append(position)
+        self.grams = {gram: tuple(positions) for gram, positions in grams.items()}
+
+        # Positions sorted by normalized name so prefix lookups are a
+        # binary search.
+        self.sorted_positions = sorted(
+            range(len(self.processed)),
+            key=lambda position: (self.processed[position], position),
+        )
+
+    def __len__(self):
+        return len(self.choices)
+
+    def candidates(self, processed_query):
+        """
+        Returns the positions of all the choices that share at least
+        one n-gram with the query. Queries too short to have a full
+        n-gram use every choice that contains them instead.
+        """
+        if len(processed_query) < self.ngram_size:
+            return [
+                position
+                for position, processed in enumerate(self.processed)
+                if processed_query in processed
+            ]
+
+        positions = set()
+        for gram in ngrams(processed_query, self.ngram_size):
+            positions.update(self.grams.get(gram, ()))
+        return sorted(positions)
+
+    def score(self, processed_query, positions):
+        """
+        Scores the choices at the given positions and returns the
+        position and score of the best one. Ties are resolved in
+        favour of the earliest choice like extractOne does.
+        """
+        best_position, best_score = None, -1
+        for position in positions:
+            score = fuzz.WRatio(processed_query, self.processed[position])
+            if score > best_score:
+                best_position, best_score = position, score
+        return best_position, best_score
+
+    def extract_one(self, query):
+        """
+        Returns a (choice, score) tuple for the best match of the
+        query, or None if the index is empty.
+        """
+        if not self.choices:
+            return None
+
+        processed_query = normalize(query)
+        if not processed_query:
+            return self.choices[0], 0
+
+        position = self.exact.get(processed_query)
+        if position is not None:
+            return self.choices[position], 100
+
+        candidates = self.candidates(processed_query)
+        position, score = self.score(processed_query, candidates)
+        candidates = set(candidates)
+        query_profile = profile(processed_query)
+        for other in range(len(self.choices)):
+            if other in candidates:
+                continue
+            # extractOne keeps the earliest of equally scored choices.
+            beats = score + 1 if position is None or other > position else score
+            processed = self.processed[other]
+            if not processed:
+                # Choices like "-" normalize to nothing, which WRatio
+                # scores 0 and the bounds can't divide by.
+                other_score = 0
+            elif length_bound(processed_query, processed) < beats:
+                continue
+            elif wratio_bound(query_profile, processed) < beats:
+                continue
+            else:
+                other_score = fuzz.WRatio(processed_query, processed)
+            if other_score >= beats:
+                position, score = other, other_score
+
+        return self.choices[position], score
+
+    def prefix(self, query, limit=5):
+        """
+        Returns up to limit choices whose normalized name starts with
+        the normalized query, in alphabetical order.
+        """
+        processed_query = normalize(query)
+        processed = self.processed
+        start = bisect.bisect_left(
+            self.sorted_positions, processed_query, key=processed.__getitem__
+        )
+        matches = []
+        for index in range(start, len(self.sorted_positions)):
+            position = self.sorted_positions[index]
+            if len(matches) >= limit or not processed[position].startswith(
+                processed_query
+            ):
+                break
+            matches.append(self.choices[position])
+        return matches
+
+    def extract(self, query, limit=5, score_cutoff=0, deadline=None):
+        """
+        Returns up to limit (choice, score) tuples scoring above the
+        cutoff, best first like process.extract. Everything is scored
+        if the candidates don't provide enough matches.
+
+        If a deadline, a time.perf_counter value, is given scoring
+        stops once it passes and the best matches found so far are
+        returned, starting with the candidates.
+        """
+        processed_query = normalize(query)
+        if not processed_query:
+            return []
+
+        def score_positions(positions, scored):
+            for count, position in enumerate(positions):
+                # Only check the time every so often, it's not free.
+                if deadline is not None and not count % 16:
+                    if time.perf_counter() > deadline:
+                        return False
+                score = fuzz.WRatio(processed_query, self.processed[position])
+                if score > score_cutoff:
+                    scored.append((position, score))
+            return True
+
+        candidates = self.candidates(processed_query)
+        scored = []
+        finished = score_positions(candidates, scored)
+        if finished and len(scored) < limit:
+            # Score the rest and keep everything in position order so
+            # ties are broken the same way as a full scan.
+            candidates = set(candidates)
+            score_positions(
+                (
+                    position
+                    for position in range(len(self.choices))
+                    if position not in candidates
+                ),
+                scored,
+            )
+            scored.sort()
+
+        matches = heapq.nlargest(limit, scored, key=lambda item: item[1])
+        return [(self.choices[position], score) for position, score in matches]
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+import re
+import shlex
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    # Queries across the roster aren't available without numpy, the
+    # rest of the frame data commands work the same.
+    np = None
+
+
+# The numeric columns of the table and the names they can be
+# queried by.
+COLUMNS = {
+    "startup": "startup",
+    "active": "active",
+    "recovery": "recovery",
+    "onhit": "onHit",
+    "hit": "onHit",
+    "onblock": "onBlock",
+    "block": "onBlock",
+}
+OPERATORS = {
+    "<=": operator.le,
+    ">=": operator.ge,
+    "!=": operator.ne,
+    "==": operator.eq,
+    "=": operator.eq,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+# Columns where bigger numbers are better, sorted descending when no
+# order is asked for.
+DESCENDING = {"onHit", "onBlock"}
+# Keeps the response under discords message length limit.
+MAX_LIMIT = 15
+# First signed number in values like "+2", "-6~-4", "5(7)" or "1-3".
+number_regex = re.compile(r"[+-]?\d+")
+filter_regex = re.compile(r"^(\w+)\s*(<=|>=|!=|==|=|<|>)\s*(.+)$")
+
+
+def parse_frames(value):
+    """
+    Returns the frame count of a value as a float, or nan if it
+    isn't a number like "KD" or "-".
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, str):
+        return float("nan")
+    result = number_regex.search(value)
+    if not result:
+        return float("nan")
+    return float(result.group(0))
+
+
+class MoveTable:
+    """
+    Column oriented copy of the numeric frame data of every move of
+    every character in a game, so questions like "all moves with
+    startup <= 4" are answered by a few vectorized comparisons
+    instead of walking every move.
+
+    Rows are the moves of each char in each of their states, with
+    the name columns kept as plain lists and the frame counts as
+    float arrays where nan means the move doesn't have a number.
+    """
+
+    def __init__(self, chars, states, moves, columns):
+        # Maps every name of a char, including aliases, to its id.
+        self.chars = chars
+        self.states = states
+        self.moves = moves
+        state_ids = {state: position for position, state in enumerate(states)}
+        self.char_ids = np.array([chars[char] for char, _, _ in moves], dtype=np.int32)
+        self.state_ids = np.array(
+            [state_ids[state] for _, state, _ in moves], dtype=np.int32
+        )
+        self.columns = {
+            name: np.array(values, dtype=np.float64) for name, values in columns.items()
+        }
+
+    def __len__(self):
+        return len(self.moves)
+
+    def select(self, filters, char=None, state="normal", sort=None, limit=10):
+        """
+        Returns the (char, state, move) rows matching all the
+        (column, operator, value) filters sorted by the sort column,
+        descending if it starts with a "-". Moves without a number
+        in a filtered or sorted column never match.
+        """
+        mask = np.ones(len(self.moves), dtype=bool)
+        if char is not None:
+            mask &= self.char_ids == self.chars[char]
+        if state is not None:
+            if state not in self.states:
+                return []
+            mask &= self.state_ids == self.states.index(state)
+        for column, compare, value in filters:
+            values = self.columns[column]
+            mask &= ~np.isnan(values) & compare(values, value)
+
+        rows = np.flatnonzero(mask)
+        if sort:
+            descending = sort.startswith("-")
+            values = self.columns[sort.lstrip("-")][rows]
+            rows = rows[~np.isnan(values)]
+            values = values[~np.isnan(values)]
+            order = np.argsort(-values if descending else values, kind="stable")
+            rows = rows[order]
+
+        return [self.moves[row] for row in rows[:limit]]
+
+
+def build_table(chars):
+    """
+    Builds a MoveTable out of the processed chars of a dataset,
+    returns None if numpy isn't installed. Aliases of a char, which
+    share its data, are only added to the table once.
+    """
+    if np is None:
+        return None
+
+    names = {}
+    ids = {}
+    states = []
+    moves = []
+    columns = {column: [] for column in set(COLUMNS.values())}
+    for char, char_data in chars.items():
+        if id(char_data) in ids:
+            names[char] = ids[id(char_data)]
+            continue
+        names[char] = ids[id(char_data)] = len(ids)
+        for state, state_moves in char_data["moves"].items():
+            if state not in states:
+                states.append(state)
+            for move, move_data in state_moves.items():
+                moves.append((char, state, move))
+                for column, values in columns.items():
+                    values.append(parse_frames(move_data.get(column)))
+
+    return MoveTable(names, states, moves, columns)
+
+
+def parse_query(query):
+    """
+    Parses a query like "startup<=4 onblock>=-2 char=ryu limit=5"
+    into a dict of its parts, values with spaces are quoted like
+    char="dee jay". Raises ValueError for anything it can't make
+    sense of.
+    """
+    parsed = {
+        "filters": [],
+        "char": None,
+        "state": "normal",
+        "sort": None,
+        "limit": 10,
+    }
+    # shlex raises ValueError itself for unbalanced quotes.
+    terms = shlex.split(re.sub(r"\s*(<=|>=|!=|==|=|<|>)\s*", r"\1", query))
+    for term in terms:
+        result = filter_regex.match(term)
+        if not result:
+            raise ValueError("I don't understand %s" % term)
+        key, op, value = result.groups()
+        key = key.lower()
+
+        if key == "limit" and op in ("=", "=="):
+            if not value.isdigit():
+                raise ValueError("%s isn't a number" % value)
+            parsed["limit"] = min(int(value), MAX_LIMIT)
+        elif key in ("char", "state", "sort") and op in ("=", "=="):
+            if key == "sort":
+                column = COLUMNS.get(value.lstrip("-").lower())
+                if column is None:
+                    raise ValueError("Can't sort by %s" % value)
+                value = "-" + column if value.startswith("-") else column
+            parsed[key] = value
+        elif key in COLUMNS:
+            try:
+                number = float(value)
+            except ValueError:
+                raise ValueError("%s isn't a number" % value)
+            parsed["filters"].append((COLUMNS[key], OPERATORS[op], number))
+        else:
+            raise ValueError("I don't know what %s is" % key)
+
+    if not parsed["filters"] and not parsed["sort"]:
+        raise ValueError("Give me at least one filter like startup<=4")
+    # Default to showing the best of the matching moves first.
+    if not parsed["sort"]:
+        column = parsed["filters"][0][0]
+        parsed["sort"] = "-" + column if column in DESCENDING else column
+    return parsed
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+import json
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+
+
+class Histogram:
+    """
+    HDR style histogram of durations. Values are kept in microseconds
+    in log-linear buckets, each power of two split into sub-buckets,
+    so memory stays fixed no matter how many values are recorded while
+    any percentile is accurate to within about 1%.
+    """
+
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_mask = (1 << sub_bucket_bits) - 1
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def bucket(self, value):
+        """
+        Returns the bucket index for a value in microseconds. Values
+        smaller than the number of sub-buckets get their own bucket.
+        """
+        shift = max(value.bit_length() - self.sub_bucket_bits, 0)
+        return (shift << self.sub_bucket_bits) + (value >> shift)
+
+    def bucket_value(self, index):
+        """
+        Returns the largest value that falls into the bucket.
+        """
+        shift = index >> self.sub_bucket_bits
+        if not shift:
+            return index
+        return (((index & self.sub_bucket_mask) + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, percent):
+        """
+        Returns the value in seconds that percent of the recorded
+        values are less than or equal to.
+        """
+        if not self.count:
+            return 0
+        target = max(self.count * percent / 100, 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.bucket_value(index), self.max) / 1000000
+        return self.max / 1000000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count / 1000000 if self.count else 0,
+            "min": (self.min or 0) / 1000000,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.max / 1000000,
+        }
+
+
+histograms = defaultdict(Histogram)
+counters = Counter()
+# The command being handled, the time spent in each of its stages and
+# its counters, set by trace so that stages timed deep inside the
+# commands get attributed to the command that caused them.
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def trace(command):
+    """
+    Collects stage timings and counters for a command in the current
+    context, yielding the dicts they will be added to.
+    """
+    spans = {}
+    counts = {}
+    token = _trace.set((command, spans, counts))
+    try:
+        yield spans, counts
+    finally:
+        _trace.reset(token)
+
+
+def record(stage, seconds):
+    """
+    Records how long a stage took, both overall and for the command
+    that is being traced if there is one.
+    """
+    histograms[stage].record(seconds)
+    current = _trace.get()
+    if current is not None:
+        command, spans, _ = current
+        histograms["%s.%s" % (command, stage)].record(seconds)
+        spans[stage] = spans.get(stage, 0) + seconds
+
+
+def increment(name, value=1):
+    counters[name] += value
+    current = _trace.get()
+    if current is not None:
+        command, _, counts = current
+        counters["%s.%s" % (command, name)] += value
+        counts[name] = counts.get(name, 0) + value
+
+
+@contextmanager
+def span(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start_time)
+
+
+def timed(stage):
+    """
+    Decorator that records the time spent in a function, or
+    coroutine function, as the given stage.
+    """
+
+    def timed_decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def func_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @wraps(func)
+            def func_wrapper(*args, **kwargs):
+                with span(stage):
+                    return func(*args, **kwargs)
+
+        return func_wrapper
+
+    return timed_decorator
+
+
+def dump(extra=None):
+    """
+    Returns a snapshot of all the histograms and counters that
+    can be serialized as json.
+    """
+    stats = {
+        "time": time.time(),
+        "latency": {
+            stage: histogram.summary()
+            for stage, histogram in sorted(histograms.items())
+        },
+        "counters": dict(sorted(counters.items())),
+    }
+    if extra:
+        stats.update(extra)
+    return stats
+
+
+def write_dump(path, stats):
+    """
+    Writes a stats dump to path, or logs it if no path is given.
+    The file is replaced atomically so readers never see half of it.
+    """
+    if not path:
+        logging.info("stats: %s", json.dumps(stats))
+        return
+
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f, indent=2)
+    os.replace(tmp_path, path)
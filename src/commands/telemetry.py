@@ -0,0 +1,113 @@
+#!/usr/bin/python
+import random
+import asyncio
+import logging
+import libhoney
+from collections import deque
+from commands import stats
+
+
+class Telemetry:
+    """
+    Buffers honeycomb events so that instrumenting a call costs
+    next to nothing on the hot path.
+
+    Whether an event is kept is decided once the call is done. Slow
+    or failed calls are always kept and the rest are sampled at the
+    rate configured for their kind, so only kept events ever have
+    their fields built. Kept events wait in a bounded queue that a
+    background task flushes to libhoney in batches, dropping new
+    events while the queue is full rather than growing without bound.
+    """
+
+    def __init__(self, config=None, enabled=True):
+        config = config or {}
+        self.enabled = enabled and config.get("enabled", True)
+        # Keep one in every n events of a kind, 1 keeps them all.
+        self.sample_rates = config.get("sample_rates", {})
+        self.slow_threshold = config.get("slow_threshold", 1)
+        self.queue_size = config.get("queue_size", 10000)
+        self.batch_size = config.get("batch_size", 500)
+        self.flush_interval = config.get("flush_interval", 5)
+        self.queue = deque()
+        self.flush_task = None
+
+    def sample_rate(self, kind, duration, failed):
+        """
+        Returns the rate the event was sampled at, or 0 if it
+        should be dropped.
+        """
+        if failed or duration >= self.slow_threshold:
+            return 1
+        rate = self.sample_rates.get(kind, 1)
+        if rate <= 1 or random.random() * rate < 1:
+            return max(rate, 1)
+        return 0
+
+    def add(self, kind, duration, failed, build_fields, *args):
+        """
+        Queues an event for a finished call. build_fields is called
+        with args to get the events fields, but only if it's kept.
+        """
+        if not self.enabled:
+            return
+        rate = self.sample_rate(kind, duration, failed)
+        if not rate:
+            stats.counters["telemetry.sampled_out"] += 1
+            return
+        if len(self.queue) >= self.queue_size:
+            stats.counters["telemetry.dropped"] += 1
+            return
+
+        fields = build_fields(*args)
+        fields["failed"] = failed
+        self.queue.append((rate, fields))
+        stats.counters["telemetry.queued"] += 1
+
+    def flush(self, limit=None):
+        """
+        Hands up to limit queued events over to libhoney, which
+        sends them on its own thread.
+        """
+        sent = 0
+        while self.queue and (limit is None or sent < limit):
+            rate, fields = self.queue.popleft()
+            ev = libhoney.Event(data=fields)
+            ev.sample_rate = rate
+            try:
+                # The event was already sampled by us, so libhoney
+                # only needs to pass on the rate.
+                ev.send_presampled()
+            except libhoney.SendError:
+                stats.counters["telemetry.failed"] += 1
+                continue
+            sent += 1
+        stats.counters["telemetry.sent"] += sent
+        return sent
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # Flush in batches so a backlog doesn't block the
+                # event loop for long.
+                while self.flush(self.batch_size) == self.batch_size:
+                    await asyncio.sleep(0)
+            except Exception:
+                logging.exception("failed to flush telemetry")
+
+    def start(self):
+        if self.enabled and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_loop())
+
+    def close(self):
+        """
+        Sends anything left in the queue and waits for libhoney
+        to finish sending it.
+        """
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.enabled:
+            self.flush()
+            libhoney.close()
@@ -1,54 +1,109 @@
 #!/usr/bin/python
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict
 from functools import wraps
+from commands import stats
 import functools
 import requests
+import sqlite3
+import pickle
 import aiohttp
+import asyncio
 import logging
+import heapq
 import time
 
 
-def rate_limit(time_gap):
+class RateLimiter:
+    """
+    Token bucket rate limiter keyed by arbitrary hashable keys.
+
+    Each key gets a bucket of burst tokens that refills at one token
+    every time_gap seconds, so burst=1 allows one use per time_gap.
+    Buckets are forgotten once they'd be full again, using a heap of
+    expiry times, so memory only grows with recently active keys.
+    """
+
+    def __init__(self, time_gap, burst=1):
+        self.time_gap = time_gap
+        self.burst = burst
+        # key -> (tokens, time of last update, time the bucket is full)
+        self._buckets = {}
+        self._expiry = []
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def evict(self, now):
+        """
+        Forgets the buckets that have refilled completely by now.
+        """
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            bucket = self._buckets.get(key)
+            # Skip stale heap entries for buckets used again since.
+            if bucket and bucket[2] == expires_at:
+                del self._buckets[key]
+
+    def hit(self, key, now=None):
+        """
+        Takes a token for the key if one is available. Returns 0 if
+        it was allowed and otherwise the seconds until it will be.
+        """
+        now = time.monotonic() if now is None else now
+        self.evict(now)
+
+        tokens, updated, _ = self._buckets.get(key, (self.burst, now, now))
+        tokens = min(self.burst, tokens + (now - updated) / self.time_gap)
+        if tokens < 1:
+            return (1 - tokens) * self.time_gap
+
+        tokens -= 1
+        expires_at = now + (self.burst - tokens) * self.time_gap
+        self._buckets[key] = (tokens, now, expires_at)
+        heapq.heappush(self._expiry, (expires_at, key))
+        return 0
+
+
+_rate_limit_scopes = {
+    "user": lambda *args, **kwargs: args[2],
+    "global": lambda *args, **kwargs: None,
+}
+
+
+def rate_limit(time_gap, burst=1, scope="user"):
     """
     Decorator that limits how often a user can use
-    a function.
+    a function. scope can be set to "global" to share
+    the limit between everyone, or to a function that's
+    called with the arguments of the call and returns
+    what to limit by, e.g. the channel. burst allows
+    that many uses before having to wait.
     """
-    _time = {}
+    limiter = RateLimiter(time_gap, burst)
+    scope_key = scope if callable(scope) else _rate_limit_scopes[scope]
 
     def rate_decorator(func):
         @wraps(func)
         async def func_wrapper(*args, **kwargs):
 
             user = args[2]
-            # Use the combination of the users name and
-            # and function name for the key. Simple way of handling
-            # per user per function times.
-            hash_key = user + func.__name__
-            if hash_key in _time:
-
-                time_diff = time.time() - _time[hash_key]
-                if time_diff > time_gap:
-                    _time[hash_key] = time.time()
-                    return await func(*args, **kwargs)
-                else:
-                    delta = timedelta(seconds=time_gap - time_diff)
-                    time_format = datetime(1, 1, 1) + delta
-                    return (
-                        "Nice try %s, but I've already done this for you. "
-                        "You can ask me again in %s days, %s hours, %s"
-                        " minutes and %s seconds."
-                    ) % (
-                        user,
-                        time_format.day - 1,
-                        time_format.hour,
-                        time_format.minute,
-                        time_format.second,
-                    )
-
-            else:
-                _time[hash_key] = time.time()
+            # Use the combination of the scope and function name
+            # for the key. Simple way of handling per user per
+            # function times.
+            wait = limiter.hit((scope_key(*args, **kwargs), func.__name__))
+            if not wait:
                 return await func(*args, **kwargs)
 
+            minutes, seconds = divmod(int(wait), 60)
+            hours, minutes = divmod(minutes, 60)
+            days, hours = divmod(hours, 24)
+            return (
+                "Nice try %s, but I've already done this for you. "
+                "You can ask me again in %s days, %s hours, %s"
+                " minutes and %s seconds."
+            ) % (user, days, hours, minutes, seconds)
+
         return func_wrapper
 
     return rate_decorator
@@ -57,41 +112,251 @@ def rate_limit(time_gap):
 def memoize(cache_time):
     """
     Decorator that memoizes the result of the function call
-    for the specified time period.
+    for the specified time period in the backend returned by
+    get_cache. Concurrent calls that miss the cache share a single
+    evaluation of the function instead of each starting their own.
     """
-    _cache = {}
+    _in_flight = {}
 
     def memoize_decorator(func):
+        # The key has to be the same in every process sharing a cache.
+        key = "%s.%s" % (func.__module__, func.__qualname__)
+
+        async def refill(*args, **kwargs):
+            returned_result = await func(*args, **kwargs)
+            await get_cache().set(key, returned_result)
+            return returned_result
+
+        def evaluate(*args, **kwargs):
+            """
+            Returns the pending evaluation of the function if there is
+            one, otherwise starts a new one that later callers can
+            join.
+            """
+            task = _in_flight.get(func)
+            if task is None:
+                task = asyncio.ensure_future(refill(*args, **kwargs))
+                _in_flight[func] = task
+                task.add_done_callback(lambda _: _in_flight.pop(func, None))
+            # Shield the shared task so a cancelled caller doesn't
+            # cancel the refill for everyone else waiting on it.
+            return asyncio.shield(task)
+
         @wraps(func)
         async def func_wrapper(*args, **kwargs):
             """
             Returns the cached value if it exists and otherwise
             it evalues the function and stores it in the cache.
-            no_cache=True can be passed to the function to prevent
-            retrieving from the cache.
+            max_age=seconds can be passed to the function to only
+            accept a cached value younger than that, and no_cache=True
+            to prevent retrieving from the cache.
             """
-            no_cache = kwargs.get("no_cache", False)
-            if func in _cache and not no_cache:
-                stored_time = _cache[func][1]
-
-                if time.time() - stored_time > cache_time:
-                    logging.info("cache expired for %s so refilling", func)
-                    returned_result = await func(*args, **kwargs)
-                    _cache[func] = (returned_result, time.time())
-
-                return _cache[func][0]
+            max_age = 0 if kwargs.get("no_cache") else kwargs.get("max_age", cache_time)
+            if max_age:
+                entry = await get_cache().get(key, max_age)
+                if entry is not None:
+                    stats.increment("cache.hits")
+                    return entry[0]
 
-            else:
-                logging.info("no cache for %s, so cache busting", func)
-                returned_result = await func(*args, **kwargs)
-                _cache[func] = (returned_result, time.time())
-                return returned_result
+            logging.info("no cache for %s, so cache busting", key)
+            stats.increment("cache.misses")
+            return await evaluate(*args, **kwargs)
 
         return func_wrapper
 
     return memoize_decorator
 
 
+class LRUCache:
+    """
+    Small bounded mapping that evicts the least recently used
+    entry once it's full.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            self._entries.move_to_end(key)
+        except KeyError:
+            return default
+        return self._entries[key]
+
+    def set(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class MemoryCache:
+    """
+    Cache backend that keeps values in this process, evicting the
+    least recently used once maxsize values are stored.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.entries = LRUCache(maxsize)
+        self.hits = Counter()
+
+    async def get(self, key, max_age):
+        """
+        Returns the (value, stored time) of the key if it was stored
+        less than max_age seconds ago, None otherwise.
+        """
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[1] > max_age:
+            return None
+        self.hits[key] += 1
+        return entry
+
+    async def set(self, key, value):
+        self.entries.set(key, (value, time.time()))
+
+    async def hit_counts(self):
+        return dict(self.hits)
+
+    async def close(self):
+        self.entries.clear()
+
+
+class SQLiteCache:
+    """
+    Cache backend kept in a sqlite database, so every process using
+    the same file shares the cached values and how often each one
+    was used. Values are pickled and the database is only touched
+    from a thread of its own to keep the blocking calls off the loop.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            # Lets the other processes read while one is writing.
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, "
+                "value BLOB NOT NULL, stored_time REAL NOT NULL, "
+                "hits INTEGER NOT NULL DEFAULT 0)"
+            )
+        return self.connection
+
+    def _get(self, key, max_age):
+        connection = self.connect()
+        with connection:
+            row = connection.execute(
+                "SELECT value, stored_time FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[1] > max_age:
+                return None
+            connection.execute("UPDATE cache SET hits = hits + 1 WHERE key = ?", (key,))
+        return pickle.loads(row[0]), row[1]
+
+    def _set(self, key, value, stored_time):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logging.exception("can't store %s in the cache", key)
+            return
+        connection = self.connect()
+        with connection:
+            # Keeps whichever process stored the newest value.
+            connection.execute(
+                "INSERT INTO cache (key, value, stored_time) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, "
+                "stored_time = excluded.stored_time "
+                "WHERE excluded.stored_time > cache.stored_time",
+                (key, blob, stored_time),
+            )
+
+    def _hit_counts(self):
+        return dict(self.connect().execute("SELECT key, hits FROM cache"))
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    async def get(self, key, max_age):
+        try:
+            return await self.run(self._get, key, max_age)
+        except sqlite3.Error:
+            logging.exception("failed to read %s from the cache", key)
+            return None
+
+    async def set(self, key, value):
+        try:
+            await self.run(self._set, key, value, time.time())
+        except sqlite3.Error:
+            logging.exception("failed to write %s to the cache", key)
+
+    async def hit_counts(self):
+        return await self.run(self._hit_counts)
+
+    async def close(self):
+        await self.run(self._close)
+        self.executor.shutdown(wait=False)
+
+
+_cache = None
+_cache_config = {}
+
+
+def configure_cache(config=None):
+    """
+    Stores the settings for the memoize cache backend. Has to be
+    called before the first memoized call to have any effect.
+    """
+    global _cache_config
+    _cache_config = config or {}
+
+
+def get_cache():
+    """
+    Returns the backend memoize stores its values in, creating
+    it on first use. Either "memory", private to this process, or
+    "sqlite", shared by every process using the same path.
+    """
+    global _cache
+    if _cache is None:
+        if _cache_config.get("backend") == "sqlite":
+            _cache = SQLiteCache(_cache_config.get("path", "cache.sqlite"))
+        else:
+            _cache = MemoryCache(_cache_config.get("maxsize", 1024))
+    return _cache
+
+
+async def close_cache():
+    """
+    Closes the cache backend if one was created. Should be called
+    by the bots when they shut down.
+    """
+    global _cache
+    if _cache is not None:
+        await _cache.close()
+    _cache = None
+
+
 _callbacks = {}
 
 
@@ -118,21 +383,121 @@ def get_callbacks():
     return _callbacks
 
 
+_session = None
+_session_config = {}
+
+
+def configure_session(config=None):
+    """
+    Stores the settings for the shared http session. Has to be
+    called before the first request to have any effect.
+    """
+    global _session_config
+    _session_config = config or {}
+
+
+def get_session():
+    """
+    Returns the process wide aiohttp session, creating it on first
+    use. Sharing one session keeps connections to the same hosts
+    alive between requests instead of paying for a new TCP/TLS
+    handshake and DNS lookup every time.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=_session_config.get("limit", 100),
+            limit_per_host=_session_config.get("limit_per_host", 10),
+            keepalive_timeout=_session_config.get("keepalive_timeout", 60),
+            ttl_dns_cache=_session_config.get("dns_cache_ttl", 300),
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=_session_config.get("timeout", 30),
+            connect=_session_config.get("connect_timeout", 10),
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session():
+    """
+    Closes the shared http session if one was opened. Should be
+    called by the bots when they shut down.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+_executors = {}
+
+
+def get_executor(kind="thread", workers=None):
+    """
+    Returns the shared executor of the given kind, either "thread"
+    or "process", creating it on first use.
+    """
+    if kind not in _executors:
+        if kind == "process":
+            _executors[kind] = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _executors[kind] = ThreadPoolExecutor(max_workers=workers)
+    return _executors[kind]
+
+
+async def run_in_executor(kind, workers, func, *args):
+    """
+    Runs CPU heavy work in a shared executor so it doesn't stall
+    the event loop. kind="none" runs it inline instead.
+    """
+    if kind == "none":
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(kind, workers), functools.partial(func, *args)
+    )
+
+
+def shutdown_executors():
+    """
+    Shuts down the executors started by run_in_executor.
+    """
+    for executor in _executors.values():
+        executor.shutdown(wait=False)
+    _executors.clear()
+
+
+async def conditional_request(url, response_headers=None, parse_json=True):
+    """
+    Makes a get request revalidating against the etag and
+    Last-Modified headers of a previous response if given.
+    Returns the status, the json body if the status is 200
+    and the response headers. parse_json=False returns the
+    raw body instead so it can be decoded off the loop.
+    """
+    headers = {}
+    if response_headers:
+        if response_headers.get("etag"):
+            headers["If-None-Match"] = response_headers["etag"]
+        if response_headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = response_headers["Last-Modified"]
+
+    async with get_session().get(url, headers=headers) as resp:
+        logging.info("Request response for url %s, is %s", url, resp.status)
+        if resp.status == 200:
+            if parse_json:
+                return resp.status, await resp.json(), resp.headers
+            return resp.status, await resp.read(), resp.headers
+        return resp.status, None, resp.headers
+
+
 async def get_request(url, response_headers=None):
     """
     Wrapper to handle get requests asyncronously.
     Returns the text if the status is 200, False
     otherwise.
     """
-    headers = {}
-    if response_headers:
-        headers = {
-            "etag": response_headers["etag"],
-            "If-Modified-Since": response_headers["Last-Modified"],
-        }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as resp:
-            logging.info("Request response for url %s, is %s", url, resp.status)
-            if resp.status == 200:
-                return await resp.json(), resp.headers
-            return False, resp.headers
+    status, body, headers = await conditional_request(url, response_headers)
+    if status == 200:
+        return body, headers
+    return False, headers
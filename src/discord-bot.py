@@ -1,10 +1,12 @@
 #!/usr/bin/python
 import os
 import yaml
+import argparse
 import logging
 import discord
 import asyncio
 import interface
+from commands import utilities
 from typing import Optional
 from typing import Literal, List
 import time
@@ -13,6 +15,11 @@ start_time = time.time()
 from discord import app_commands
 
 logging.basicConfig(level=logging.INFO)
+parser = argparse.ArgumentParser()
+# Set by shard-launcher.py for each of the processes it runs.
+parser.add_argument("--shard-ids", help="comma separated shards to run")
+parser.add_argument("--shard-count", type=int, help="total shards of the bot")
+args = parser.parse_args()
 
 
 class MyClient(discord.Client):
@@ -49,9 +56,21 @@ class MyClient(discord.Client):
                 self.config.get("discord", {}).get("status_interval", 3600)
             )
 
+    async def close(self):
+        self.tree_interface.telemetry.close()
+        await utilities.close_session()
+        await utilities.close_cache()
+        utilities.shutdown_executors()
+        await super().close()
+
     async def setup_hook(self):
         self.loop.create_task(self.update_playing_status())
         self.loop.create_task(self.tree_interface.load(self))
+        # Every shard has the same commands, so when the bot is split
+        # over processes only the one running shard 0 syncs them.
+        shard_ids = getattr(self, "shard_ids", None)
+        if shard_ids is not None and 0 not in shard_ids:
+            return
         debug_guild_id = self.config["discord"].get("debug_guild_id")
         if debug_guild_id:
             debug_guild = discord.Object(id=debug_guild_id)
@@ -62,18 +81,34 @@ class MyClient(discord.Client):
             await self.tree.sync()
 
 
+class MyShardedClient(MyClient, discord.AutoShardedClient):
+    """
+    Runs some of the bots shards in this process, see shard-launcher.py.
+    """
+
+
 config_path = os.path.join(os.path.dirname(__file__), "../conf/bots.yaml")
 config = yaml.load(open(config_path).read())
-client = MyClient(
-    intents=discord.Intents.default(),
-    application_id=config["discord"]["application_id"],
-)
+if args.shard_count:
+    client = MyShardedClient(
+        intents=discord.Intents.default(),
+        application_id=config["discord"]["application_id"],
+        shard_ids=[int(shard_id) for shard_id in args.shard_ids.split(",")],
+        shard_count=args.shard_count,
+    )
+    # The launcher keeps the frame data fresh for all of its processes.
+    config["frame_data"]["follow_snapshots"] = True
+else:
+    client = MyClient(
+        intents=discord.Intents.default(),
+        application_id=config["discord"]["application_id"],
+    )
 
 
 @client.tree.command()
 @app_commands.describe(
-    char_name="The characters name",
-    move_name="The move name",
+    char_name="The characters name, or several separated by commas",
+    move_name="The move name, or several separated by commas",
     vtrigger="Optional vtrigger mode",
 )
 async def sfv(
@@ -96,8 +131,8 @@ def populate_choices(values):
 
 @client.tree.command()
 @app_commands.describe(
-    char_name="The characters name",
-    move_name="The move name",
+    char_name="The characters name, or several separated by commas",
+    move_name="The move name, or several separated by commas",
 )
 async def ggst(interaction: discord.Interaction, char_name: str, move_name: str):
     """Get Guilty Gear Strive frame data for the specific char and move.
@@ -110,8 +145,8 @@ async def ggst(interaction: discord.Interaction, char_name: str, move_name: str)
 
 @client.tree.command()
 @app_commands.describe(
-    char_name="The characters name",
-    move_name="The move name",
+    char_name="The characters name, or several separated by commas",
+    move_name="The move name, or several separated by commas",
     char_state="Optional char specific states like Installs.",
 )
 async def sf6(
@@ -221,6 +256,25 @@ async def move_autocomplete(
         )
 
 
+@client.tree.command()
+@app_commands.describe(
+    game="The game to search",
+    query='Filters like startup<=4 char="dee jay" state=vt1, states are normal, vt1, vt2 or sf6 stances',
+)
+async def query(
+    interaction: discord.Interaction,
+    game: Literal["sfv", "ggst", "sf6"],
+    query: str,
+):
+    """Find moves across the whole roster by their frame data.
+
+    Filter on startup, active, recovery, onhit and onblock, optionally
+    for a single char or state, and sort by any of them."""
+    return await client.tree_interface.handle_slash_command(
+        interaction, "query", game, query
+    )
+
+
 @client.tree.command()
 async def charming(interaction: discord.Interaction):
     """charming"""
@@ -233,6 +287,8 @@ def main():
     client.commands.update(config.get("admin_actions", {}))
     client.max_retries = config.get("max_retries", 3)
     client.config = config
+    utilities.configure_session(config.get("http", {}))
+    utilities.configure_cache(config.get("cache", {}))
     client.tree_interface = interface.TreeHandling(client, config)
     token = config["discord"]["token"]
     client.run(token)
@@ -1,36 +1,69 @@
 #!/usr/bin/python
+import random
 import asyncio
 import discord
 import logging
 import libhoney
 from functools import wraps
-from commands import ifgc, actions
+from commands import ifgc, actions, stats, utilities
+from commands.telemetry import Telemetry
 import time
 
 CLIENT = None
 
 
-def build_event(interaction, command, start_time):
-    return libhoney.Event(
-        data={
-            "guild_name": interaction.guild.name,
-            "guild_member_count": interaction.guild.member_count,
-            "command": command,
-            "response_time": time.time() - start_time,
-            "message_time": time.time() - interaction.created_at.timestamp(),
-            "user_response_time": time.time() - interaction.created_at.timestamp(),
-            "latency": CLIENT.latency,
-        }
-    )
+def build_event(interaction, command, duration, extra=None):
+    """
+    Returns the fields of the honeycomb event for a call. Only called
+    for events that are kept, so none of this is on the hot path.
+    """
+    now = time.time()
+    message_time = now - interaction.created_at.timestamp()
+    guild = interaction.guild
+    fields = {
+        # Guild is None for commands used in DMs.
+        "guild_name": guild.name if guild else None,
+        "guild_member_count": guild.member_count if guild else None,
+        "command": command,
+        "response_time": duration,
+        "message_time": message_time,
+        "user_response_time": message_time,
+        "latency": CLIENT.latency,
+    }
+    if extra:
+        fields.update(extra)
+    return fields
+
 
 def monitor_slash_command(func):
     @wraps(func)
     async def func_wrapper(self, interaction, command, *args, **kwargs):
-        start_time = time.time()
-        result = await func(self, interaction, command, *args, **kwargs)
-        ev = build_event(interaction, command, start_time)
-        if len(args) == 2:
-            ev.add({"char_name": args[0], "move_name": args[1]})
+        start_time = time.perf_counter()
+        failed = True
+        # Time spent in each stage of the command, like fetching the
+        # data or sending the response, is collected into spans and
+        # how often things like retries happened into counts.
+        with stats.trace(command) as (spans, counts):
+            try:
+                result = await func(self, interaction, command, *args, **kwargs)
+                failed = False
+            finally:
+                duration = time.perf_counter() - start_time
+                stats.record("command_total", duration)
+                extra = {"%s_time" % stage: value for stage, value in spans.items()}
+                extra.update(counts)
+                if len(args) == 2 and command in self.module_mapping:
+                    extra.update({"char_name": args[0], "move_name": args[1]})
+                self.telemetry.add(
+                    "command",
+                    duration,
+                    failed,
+                    build_event,
+                    interaction,
+                    command,
+                    duration,
+                    extra,
+                )
         return result
 
     return func_wrapper
@@ -39,17 +72,30 @@ def monitor_slash_command(func):
 def monitor_autocomplete(func):
     @wraps(func)
     async def func_wrapper(self, module_name, interaction, *args):
-        start_time = time.time()
-        ev = build_event(interaction, func.__name__, start_time)
-        ev.add({"module_name": module_name, "char_name": args[0]})
-        try:
-            ev.add({"move_name": args[1]})
-        except IndexError:
-            pass
-
-        result = await func(self, module_name, interaction, *args)
-
-        ev.send()
+        start_time = time.perf_counter()
+        failed = True
+        with stats.trace("%s.%s" % (module_name, func.__name__)):
+            try:
+                result = await func(self, module_name, interaction, *args)
+                failed = False
+            finally:
+                duration = time.perf_counter() - start_time
+                # Kept apart from commands so the far more frequent
+                # autocomplete calls don't drown out their latencies.
+                stats.record("autocomplete_total", duration)
+                extra = {"module_name": module_name, "char_name": args[0]}
+                if len(args) > 1:
+                    extra["move_name"] = args[1]
+                self.telemetry.add(
+                    "autocomplete",
+                    duration,
+                    failed,
+                    build_event,
+                    interaction,
+                    func.__name__,
+                    duration,
+                    extra,
+                )
         return result
 
     return func_wrapper
@@ -67,32 +113,132 @@ class TreeHandling:
             "ggst": self.gg_module,
             "sf6": self.sf6_module,
         }
+        self.refresh_tasks = []
+        # Tasks of the commands being run and their args, keyed by
+        # coalesce_key.
+        self.in_flight = {}
         self.command_mapping = {
             "sfv": self.sf_module.slash_sfv,
             "ggst": self.gg_module.slash_strive,
             "charming": actions_module.charming,
             "sf6": self.sf6_module.slash_sf6,
+            "query": self.query_moves,
         }
         libhoney.init(
             writekey=config["honeycomb"]["api_key"],
             dataset=config["honeycomb"]["api_key"],
         )
+        # Events are only sent to honeycomb if there's a key to send
+        # them with, the local stats are always collected.
+        self.telemetry = Telemetry(
+            config.get("telemetry", {}), enabled=bool(config["honeycomb"]["api_key"])
+        )
+        stats_config = config.get("stats", {})
+        self.stats_interval = stats_config.get("dump_interval", 0)
+        self.stats_path = stats_config.get("dump_path") or None
+        self.stats_task = None
+        discord_config = config.get("discord", {})
+        # Seconds after an interaction was created to defer the
+        # response by, discord only waits 3 seconds for a response.
+        self.defer_after = discord_config.get("defer_after", 2)
+        self.response_timeout = discord_config.get("response_timeout", 60)
+        self.retry_backoff = discord_config.get("retry_backoff", 0.1)
+        self.retry_max_backoff = discord_config.get("retry_max_backoff", 2)
+        frame_config = config["frame_data"]
+        # Workers of a sharded bot serve the snapshots written by the
+        # launcher instead of fetching the frame data themselves.
+        self.follow_snapshots = frame_config.get("follow_snapshots", False)
+        self.snapshot_poll_interval = frame_config.get("snapshot_poll_interval", 5)
+
+    async def load_module(self, name, module):
+        """
+        Loads a single game module and starts its background refresh,
+        or follows the snapshots of the launcher in a sharded bot.
+        """
+        start_time = time.time()
+        if self.follow_snapshots:
+            # Not ready until the launcher has written a snapshot,
+            # which follow_snapshot picks up as soon as it has.
+            module.load_snapshot()
+            print("Following %s snapshot, ready: %s" % (name, module.ready))
+            self.refresh_tasks.append(
+                asyncio.create_task(module.follow_snapshot(self.snapshot_poll_interval))
+            )
+            return
+
+        self.refresh_tasks.append(await module.start())
+        print(
+            "Loaded %s in %s, ready: %s"
+            % (name, time.time() - start_time, module.ready)
+        )
 
     async def load(self, client):
         global CLIENT
         CLIENT = client
         start_time = time.time()
-        for _, module in self.module_mapping.items():
-            await module.get_data()
+        await asyncio.gather(
+            *[
+                self.load_module(name, module)
+                for name, module in self.module_mapping.items()
+            ]
+        )
         print("Interface init time is")
         print(time.time() - start_time)
+        self.telemetry.start()
+        if self.stats_interval:
+            self.stats_task = asyncio.create_task(self.dump_stats_loop())
+
+    async def get_stats(self):
+        """
+        Returns the latency histograms and counters along with how
+        the fetches of each games frame data went and how often each
+        cached value was used, by every process sharing the cache.
+        """
+        return stats.dump(
+            {
+                "fetch_counts": {
+                    name: dict(module.fetch_counts)
+                    for name, module in self.module_mapping.items()
+                },
+                "cache_hits": await utilities.get_cache().hit_counts(),
+            }
+        )
+
+    async def dump_stats_loop(self):
+        """
+        Periodically writes the stats to the configured path,
+        or to the log if there isn't one.
+        """
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            try:
+                stats.write_dump(self.stats_path, await self.get_stats())
+            except Exception:
+                logging.exception("failed to dump stats")
+
+    def is_ready(self, name):
+        """
+        Returns False for games whose frame data hasn't loaded yet,
+        commands that aren't backed by frame data are always ready.
+        """
+        module = self.module_mapping.get(name)
+        return module is None or module.ready
+
+    async def query_moves(self, game, query):
+        if not self.is_ready(game):
+            return "Frame data for %s is still loading, try again in a moment." % game
+        return await self.module_mapping[game].query_moves(query)
 
     @monitor_autocomplete
     async def autocomplete_char(self, module_name, _interaction, char_name):
+        if not self.is_ready(module_name):
+            return []
         return await self.module_mapping[module_name].autocomplete_char(char_name)
 
     @monitor_autocomplete
     async def autocomplete_move(self, module_name, _interaction, char_name, move_name):
+        if not self.is_ready(module_name):
+            return []
         return await self.module_mapping[module_name].autocomplete_move(
             char_name, move_name
         )
@@ -101,15 +247,118 @@ class TreeHandling:
     async def autocomplete_char_state(
         self, module_name, _interaction, char_name, state_name
     ):
+        if not self.is_ready(module_name):
+            return []
         return await self.module_mapping[module_name].autocomplete_char_state(
             char_name, state_name
         )
 
     @monitor_slash_command
     async def handle_slash_command(self, interaction, command, *args, **kwargs):
-        response = await self.command_mapping[command](*args, **kwargs)
+        if not self.is_ready(command):
+            await self.send_message(
+                interaction,
+                "Frame data for %s is still loading, try again in a moment." % command,
+            )
+            return
+        task = self.run_command(command, *args, **kwargs)
+        # Discord fails the interaction if it isn't responded to within
+        # a few seconds, so defer if the command is taking too long and
+        # follow up with the response once it's done.
+        try:
+            response = await asyncio.wait_for(
+                asyncio.shield(task), self.defer_budget(interaction)
+            )
+        except asyncio.TimeoutError:
+            await self.defer(interaction)
+            try:
+                # The task might be shared with other requests, so
+                # only stop waiting on it rather than cancelling it.
+                response = await asyncio.wait_for(
+                    asyncio.shield(task), self.response_timeout
+                )
+            except asyncio.TimeoutError:
+                stats.increment("timeouts")
+                response = "Sorry, that took too long. Try again in a moment."
         await self.send_message(interaction, response)
 
+    def coalesce_key(self, command, args, kwargs):
+        """
+        Returns the key identical requests share. Frame data lookups
+        are keyed by their normalized char and move so that requests
+        that would match the same way share one.
+        """
+        module = self.module_mapping.get(command)
+        options = tuple(sorted(kwargs.items()))
+        # Batches are split on commas before normalizing, so leave
+        # them as they are.
+        if module is None or len(args) < 2 or "," in args[0] + args[1]:
+            return (command, args, options)
+        return (command, module.query_key(args[0], args[1]), args[2:], options)
+
+    def run_command(self, command, *args, **kwargs):
+        """
+        Returns a task running the command. Requests identical to
+        one that's already running share its task, so a burst of the
+        same query only does the work once.
+        """
+        key = self.coalesce_key(command, args, kwargs)
+        in_flight = self.in_flight.get(key)
+        if in_flight is not None:
+            stats.increment("coalesced")
+            task, task_args = in_flight
+            if task_args == args:
+                return task
+            return asyncio.ensure_future(self.run_after(task, command, *args, **kwargs))
+
+        task = asyncio.ensure_future(self.command_mapping[command](*args, **kwargs))
+        self.in_flight[key] = (task, args)
+        task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return task
+
+    async def run_after(self, task, command, *args, **kwargs):
+        """
+        Runs the command once the task for the same query written
+        differently is done. Responses like "x with y is not a valid
+        character/move combination" echo the query back, so each gets
+        its own, but the matching and rendering are cached by then.
+        """
+        await asyncio.wait([task])
+        return await self.command_mapping[command](*args, **kwargs)
+
+    def defer_budget(self, interaction):
+        """
+        Returns how long we can wait on a command before having to
+        defer the response to the interaction.
+        """
+        elapsed = time.time() - interaction.created_at.timestamp()
+        return min(max(self.defer_after - elapsed, 0), self.defer_after)
+
+    async def defer(self, interaction):
+        stats.increment("deferrals")
+        try:
+            await interaction.response.defer(thinking=True)
+        except discord.HTTPException:
+            logging.exception("failed to defer interaction")
+
+    def retry_delay(self, attempt):
+        """
+        Exponential backoff with jitter for retrying failed sends.
+        """
+        delay = min(self.retry_backoff * 2**attempt, self.retry_max_backoff)
+        return random.uniform(delay / 2, delay)
+
+    async def send_response(self, interaction, msg=None, embed=None):
+        """
+        Sends the response to the interaction, as a follow up if it
+        has been deferred.
+        """
+        kwargs = {"embed": embed} if embed else {}
+        if interaction.response.is_done():
+            await interaction.followup.send(msg, **kwargs)
+        else:
+            await interaction.response.send_message(msg, **kwargs)
+
     async def send_message(self, interaction, response):
         # Response can be a single message or a
         # tuple of message and/or embed.
@@ -125,29 +374,43 @@ class TreeHandling:
         if msg:
             msg = "\u200B" + msg
 
-        for _ in range(client.max_retries):
-            try:
-                # Try sending only the embed message if it exists and fall
-                # back to the text message.
-                if em:
-                    await interaction.response.send_message(None, embed=em)
-                else:
-                    await interaction.response.send_message(msg)
-
-                break
-            except discord.HTTPException as e:
-                # Empty message error code which happens if you don't
-                # have permission to send embed message.
-                if e.code in [50006, 50013]:
-                    try:
-                        await interaction.response.send_message(msg)
+        with stats.span("send"):
+            retry_start = None
+            for attempt in range(client.max_retries):
+                try:
+                    # Try sending only the embed message if it exists and fall
+                    # back to the text message.
+                    if em:
+                        await self.send_response(interaction, None, embed=em)
+                    else:
+                        await self.send_response(interaction, msg)
+
+                    break
+                except discord.HTTPException as e:
+                    # Empty message error code which happens if you don't
+                    # have permission to send embed message.
+                    if e.code in [50006, 50013]:
+                        try:
+                            await self.send_response(interaction, msg)
+                            break
+                        except discord.HTTPException:
+                            pass
+                    logging.exception("failed to send message")
+                    # Unknown interaction, we ran out of time to respond
+                    # so there's no point retrying.
+                    if e.code == 10062:
+                        stats.increment("timeouts")
                         break
-                    except discord.HTTPException:
-                        pass
-                logging.exception("failed to send message")
-                await asyncio.sleep(0.1)
-        else:
-            logging.error(
-                "Failed sending %s and %s after %s retries"
-                % (msg, em, client.max_retries)
-            )
+                    stats.increment("retries")
+                    if retry_start is None:
+                        retry_start = time.perf_counter()
+                    await asyncio.sleep(self.retry_delay(attempt))
+            else:
+                logging.error(
+                    "Failed sending %s and %s after %s retries"
+                    % (msg, em, client.max_retries)
+                )
+            # Time spent from the first failed attempt until we gave up
+            # or got the message through.
+            if retry_start is not None:
+                stats.record("retry", time.perf_counter() - retry_start)
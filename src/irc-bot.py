@@ -1,7 +1,9 @@
 #!/usr/bin/python
 from googleapiclient.discovery import build
+from commands import utilities
 import functools
 import isodate
+import atexit
 import logging
 import interface
 import asyncio
@@ -25,6 +27,8 @@ class MyClient(object):
         self.url_enabled_channels = self.config.get("youtube", {}).get(
             "url_enabled_channels", []
         )
+        utilities.configure_session(self.config.get("http", {}))
+        utilities.configure_cache(self.config.get("cache", {}))
         self.interface = interface.Interface(self.config, self.commands)
         self.youtube_regex = (
             "(?:https?://)?(?:www.)?(?:youtube.com|youtu.be)/(?:watch\?)?v=([^\s]+)"
@@ -40,6 +44,16 @@ class MyClient(object):
             logging.info("Starting without youtube service")
             self.service = None
 
+    def SIGINT(self):
+        """
+        Called by irc3 right before it stops the loop, so nothing
+        scheduled on it now would run. Close the shared http session,
+        cache and executors once the loop has stopped instead.
+        """
+        atexit.register(self.bot.loop.run_until_complete, utilities.close_session())
+        atexit.register(self.bot.loop.run_until_complete, utilities.close_cache())
+        atexit.register(utilities.shutdown_executors)
+
     @irc3.event(irc3.rfc.CONNECTED)
     def connected(self, **kw):
         for channel in self.channels:
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+"""
+Runs the discord bot split over several processes, each running a range
+of its shards.
+
+    python shard-launcher.py --processes 4 --shard-count 8
+
+The launcher fetches and indexes the frame data itself, keeping the
+snapshots in frame_data.snapshot_dir fresh, and the bot processes load
+those snapshots instead of each fetching and indexing the frame data.
+"""
+
+import os
+import sys
+import yaml
+import asyncio
+import argparse
+import logging
+from commands import ifgc, utilities
+
+logging.basicConfig(level=logging.INFO)
+
+config_path = os.path.join(os.path.dirname(__file__), "../conf/bots.yaml")
+bot_path = os.path.join(os.path.dirname(__file__), "discord-bot.py")
+
+
+def split_shards(shard_count, processes):
+    """
+    Returns the shard ids each process should run, spreading the
+    shards evenly over the processes.
+    """
+    processes = max(min(processes, shard_count), 1)
+    return [list(range(shard_count))[offset::processes] for offset in range(processes)]
+
+
+async def run_shards(shard_ids, shard_count, restart_delay):
+    """
+    Runs a bot process for the shards, restarting it if it exits.
+    """
+    while True:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            bot_path,
+            "--shard-ids",
+            ",".join(str(shard_id) for shard_id in shard_ids),
+            "--shard-count",
+            str(shard_count),
+        )
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            await process.wait()
+            raise
+        logging.warning(
+            "process for shards %s exited with %s, restarting in %ss",
+            shard_ids,
+            returncode,
+            restart_delay,
+        )
+        await asyncio.sleep(restart_delay)
+
+
+async def run(config, shard_count, processes):
+    utilities.configure_session(config.get("http", {}))
+    utilities.configure_cache(config.get("cache", {}))
+    modules = [ifgc.Frames(config), ifgc.GGFrames(config), ifgc.SF6Frames(config)]
+    # The bot processes are only started once there's frame data for
+    # them to load, so they come up ready to answer. Each refresh
+    # writes a new snapshot for them to follow.
+    refresh_tasks = await asyncio.gather(*[module.start() for module in modules])
+    for module in modules:
+        logging.info("loaded %s, ready: %s", module.name, module.ready)
+
+    restart_delay = config.get("sharding", {}).get("restart_delay", 5)
+    shard_tasks = [
+        asyncio.create_task(run_shards(shard_ids, shard_count, restart_delay))
+        for shard_ids in split_shards(shard_count, processes)
+    ]
+    try:
+        await asyncio.gather(*shard_tasks)
+    finally:
+        for task in shard_tasks + refresh_tasks:
+            task.cancel()
+        await asyncio.gather(*shard_tasks, return_exceptions=True)
+        await utilities.close_session()
+        await utilities.close_cache()
+        utilities.shutdown_executors()
+
+
+def main():
+    config = yaml.load(open(config_path).read())
+    sharding = config.get("sharding", {})
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--shard-count", type=int, default=sharding.get("shard_count", 1)
+    )
+    parser.add_argument("--processes", type=int, default=sharding.get("processes", 1))
+    args = parser.parse_args()
+
+    if not config["frame_data"].get("snapshot_dir"):
+        parser.error("frame_data.snapshot_dir has to be set to share the frame data")
+    try:
+        asyncio.run(run(config, args.shard_count, args.processes))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import os
+import sys
+import random
+
+import pytest
+from fuzzywuzzy import process
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from commands.matching import MatchIndex, normalize  # noqa: E402
+
+MOVES = [
+    "Stand LP",
+    "Stand MP",
+    "Stand HP",
+    "Crouch LK",
+    "Crouch MK",
+    "Crouch HK",
+    "Jump HP",
+    "LP Shoryuken",
+    "EX Hadoken",
+    "Tatsumaki Senpukyaku",
+    "st.LP",
+    "cr.MK",
+    "j.HP",
+    "5LP",
+    "2MK",
+    "623K",
+    "2K",
+    "c.S",
+    "f.S",
+    "stand hp",
+    "fDash",
+    "bDash",
+    "throwRange",
+    "V-Trigger 1",
+    # Commands like these normalize to an empty string.
+    "-",
+    "",
+    "*",
+]
+ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789 .+"
+
+
+def typo(rng, value):
+    value = value.lower()
+    if not value:
+        return value
+    position = rng.randrange(len(value))
+    roll = rng.random()
+    if roll < 0.3:
+        return value[:position] + value[position + 1 :]
+    if roll < 0.6:
+        return value[:position] + rng.choice(ALPHABET) + value[position + 1 :]
+    return value[: rng.randint(1, len(value))]
+
+
+def queries(count, seed=0):
+    rng = random.Random(seed)
+    result = ["62kk", "sand hc", "cr mk", "st lp", "shoryu"]
+    while len(result) < count:
+        if rng.random() < 0.5:
+            query = "".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 10)))
+        else:
+            query = typo(rng, rng.choice(MOVES))
+        if normalize(query):
+            result.append(query)
+    return result
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_extract_one_matches_extract_one(seed):
+    choices = random.Random(seed).sample(MOVES, len(MOVES))
+    index = MatchIndex(choices)
+    for query in queries(500, seed):
+        assert index.extract_one(query) == process.extractOne(query, choices), query
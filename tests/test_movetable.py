@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from commands.movetable import parse_query  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        'startup<=4 char="dee jay"',
+        "startup<=4 char='dee jay'",
+        'startup <= 4 char = "dee jay"',
+    ],
+)
+def test_quoted_values(query):
+    assert parse_query(query)["char"] == "dee jay"
+
+
+@pytest.mark.parametrize(
+    "query", ["startup<=4 char=dee jay", 'startup<=4 char="dee jay']
+)
+def test_unquoted_or_unbalanced_values(query):
+    with pytest.raises(ValueError):
+        parse_query(query)